@@ -0,0 +1,79 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import logging
+import os
+import shutil
+import zipfile
+
+from cache import DirectoryCache, cloneTree, hashPath
+from utils import metadata, readInstallManifest
+
+def addonHash(path):
+  """ The content hash of an add-on. The hash of an xpi is remembered by its
+      size and mtime, so that installing it into many profiles only reads it
+      once. Unpacked add-ons are hashed each time, their files may change.
+  """
+  if os.path.isdir(path):
+    return hashPath(path)
+  return metadata.lookup("sha1", path, path, lambda: hashPath(path))
+
+class AddonCache(object):
+  """ Unpacked add-ons shared between profiles.
+
+      Add-ons are unpacked once per content hash of the xpi, or of the tree
+      for unpacked extensions like staged builds. Profiles get a hardlinked
+      copy of the unpacked add-on, so evicting a cache entry never breaks a
+      profile that uses it.
+  """
+
+  # Number of unpacked add-ons to keep, see DirectoryCache
+  CACHE_ENTRIES = 32
+
+  def __init__(self, root):
+    self.cache = DirectoryCache(root, AddonCache.CACHE_ENTRIES)
+
+  def hold(self, path):
+    """ Unpacks the add-on if needed and returns a lock on the cache entry,
+        the unpacked add-on is in its addon directory.
+    """
+    def build(entry):
+      target = os.path.join(entry, "addon")
+      if os.path.isdir(path):
+        shutil.copytree(path, target)
+      else:
+        with zipfile.ZipFile(path) as xpi:
+          xpi.extractall(target)
+
+    return self.cache.hold(addonHash(path), build)
+
+  def unpack(self, path):
+    with self.hold(path) as entry:
+      return os.path.join(entry.path, "addon")
+
+  def install(self, path, profilePath):
+    with self.hold(path) as entry:
+      return self._install(os.path.join(entry.path, "addon"), profilePath)
+
+  def _install(self, unpacked, profilePath):
+    addonId = readInstallManifest(unpacked)["id"]
+    extensionsDir = os.path.join(profilePath, "extensions")
+    target = os.path.join(extensionsDir, addonId)
+
+    # Already linked from this cache entry, nothing to do
+    manifest = os.path.join(target, "install.rdf")
+    if hasattr(os.path, "samefile") and os.path.exists(manifest) and \
+       os.path.samefile(manifest, os.path.join(unpacked, "install.rdf")):
+      return addonId
+
+    logging.info("Installing %s from %s" % (addonId, unpacked))
+    if os.path.exists(target):
+      shutil.rmtree(target)
+    if os.path.exists(target + ".xpi"):
+      os.remove(target + ".xpi")
+    if not os.path.isdir(extensionsDir):
+      os.makedirs(extensionsDir)
+
+    cloneTree(unpacked, target, linkDirs=["."])
+    return addonId
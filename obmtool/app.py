@@ -6,43 +6,120 @@
 
 import argparse
 import logging
+import multiprocessing
 import tempfile
 import traceback
+import socket
+import pickle
+import Queue
 import stat
+import copy
+import time
 import re
 import sys
 import os
 
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
 from obmtool.runner import ObmRunner
-from obmtool.config import config
-from obmtool.report import JUnitReport
+from obmtool.config import config, ObmToolConfig
+from obmtool.logfollower import LogFollower
+from obmtool.logparser import ConnectorLogParser
+from obmtool.resources import ResourceSampler, TestResources
+from obmtool.tracing import tracer
+from obmtool.signons import SignonFileEntry
+from obmtool.timings import TimingDatabase, testDurations, schedule, makespanReport
+import obmtool.certificates
+import obmtool.daemon
+import obmtool.loadtest
+import obmtool.provision
+import obmtool.resources
 import obmtool.utils
 
-from manifestparser import TestManifest
-import jsbridge
-import mozmill
-import mozmill.logger
-import mozmill.report
+# mozmill and the report are only imported when running tests, to keep
+# starting Thunderbird fast. manifestparser is loaded anyway by mozprofile.
 import mozinfo
-import mozversion
+
+def profileArgs(args):
+  return {
+    'userName': args.user,
+    'password': args.password,
+    'serverUri': args.server,
+    'tbVersion': args.tbversion,
+    'binary': args.thunderbird,
+    'addons': args.extension,
+    'cachePath': args.cachePath,
+    'nssCache': args.nssCache,
+    'templateCache': args.templateCache,
+    'addonCache': args.addonCache,
+    'preferences': args.preferences,
+    'instance': args.instance,
+    'prepared': args.prepared,
+    'standIn': args.standIn,
+    'reset': args.reset
+  }
 
 def createRunner(args):
-  return ObmRunner.create(binary=args.thunderbird, profile_args={
-                            'userName': args.user,
-                            'password': args.password,
-                            'serverUri': args.server,
-                            'tbVersion': args.tbversion,
-                            'binary': args.thunderbird,
-                            'addons': args.extension,
-                            'cachePath': args.cachePath,
-                            'preferences': args.preferences,
-                            'reset': args.reset
-                          })
-
-def parseArgs():
+  return ObmRunner.create(binary=args.thunderbird, profile_args=profileArgs(args))
+
+def setupProfile(profile):
+  # Add extra certificates from the prefs, fetching them all at once
+  hosts = []
+  for cert in filter(bool, re.split("[,\n]", config.get("profile", "certificates", ""))):
+    host,port = cert.split(":")
+    hosts.append((host, int(port)))
+  failures = profile.overrides.addEntries(hosts,
+                timeout=config.get("defaults", "certificateTimeout", 10))
+  for host, port, error in failures:
+    print "Could not get certificate from %s:%d: %s" % (host, port, error)
+
+  # Add extra signons from the prefs
+  signons = []
+  for signon in filter(bool, re.split("[,\n]", config.get("profile", "signons", ""))):
+    hostname,realm,user,password = signon.split("|")
+    signons.append(SignonFileEntry(hostname, realm, user, password))
+  profile.signons.addEntries(signons)
+
+  # Need to flush profile after adding certs/signons
+  profile.flush()
+
+def reservePorts(count):
+  """ Binds count free local ports and returns the sockets. They stay bound
+      so that no other process can take the ports, releasePorts closes them
+      right before the Thunderbird using the port starts.
+  """
+  sockets = []
+  try:
+    for i in range(count):
+      sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      sockets.append(sock)
+      if fcntl:
+        # Thunderbird and other children must not inherit the reservation
+        flags = fcntl.fcntl(sock.fileno(), fcntl.F_GETFD)
+        fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+      sock.bind(("127.0.0.1", 0))
+  except:
+    for sock in sockets:
+      sock.close()
+    raise
+  return sockets
+
+def releasePorts(args, indexes=None):
+  """ Frees the reserved jsbridge ports with the given indexes, or all. """
+  for index, sock in enumerate(getattr(args, "jsbridge_sockets", [])):
+    if indexes is None or index in indexes:
+      sock.close()
+
+def defaultConfigPath():
   home = os.path.expanduser("~")
   filename = ".obmtoolrc" if os.name == "posix" else "obmtool.ini"
-  defaultconfig = os.path.join(home, filename)
+  return os.path.join(home, filename)
+
+def createParser():
+  defaultconfig = defaultConfigPath()
 
   # When adding new arguments, DO NOT USE the config dict yet. See config file loading below.
   parser = argparse.ArgumentParser(description="Start Thunderbird with a preconfigured OBM setup")
@@ -54,26 +131,70 @@ def parseArgs():
   parser.add_argument('-e', '--extension', type=str, nargs='+', default=[], help="An additional extension to install, can be specified multiple times")
   parser.add_argument('-p', '--pref', type=str, nargs='+', default=[], metavar='key=value', help="Additional preferences to set, can be specified multiple times. Value can be a string, integer or true|false.")
   parser.add_argument('-r', '--reset', action='store_true', help="Reset the currently used profile before starting") # default: defaults.reset
+  parser.add_argument('--nss-cache', dest='nssCache', default=None, help="Directory to cache NSS helper environments in (default: paths.nssCache or an nss directory in the profile cache)")
+  parser.add_argument('--refresh-certificates', dest='refreshCertificates', action='store_true', help="Fetch server certificates again instead of using the certificate cache")
   parser.add_argument('-c', '--config', default=None, help="Config file to use (default: %s)" % defaultconfig)
   parser.add_argument('-m', '--mozmill', type=str, nargs='+', default=[], help="Run a specific mozmill test")
   parser.add_argument('--format', type=str, default='pprint-color', metavar='[pprint|pprint-color|json|xunit]', help="Mozmill output format (default: pprint-color)")
   parser.add_argument('--logfile', type=str, default=None, help="Log mozmill events to a file in addition to the console")
+  parser.add_argument('-j', '--jobs', type=int, default=1, help="Number of Thunderbird instances to run mozmill tests in parallel (default: 1)")
+  parser.add_argument('--trace', type=str, default=None, metavar='FILE', help="Write the time spent in each startup phase to FILE, in Chrome trace event format")
+  parser.add_argument('--sample', type=str, default=None, metavar='FILE', help="Sample memory, cpu, threads and open files of Thunderbird while it runs and write them to FILE, as CSV if it ends with .csv or JSON otherwise")
+  parser.add_argument('--sample-interval', dest='sampleInterval', type=float, default=1.0, metavar='SECONDS', help="Time between two resource samples (default: 1)")
+  parser.add_argument('--no-daemon', dest='daemon', action='store_false', help="Don't ask a running obmtool serve for a prepared profile")
   parser.add_argument('-v', '--verbose', action='store_true', help="Show more information about whats going on") # default: defaults.verbose
-  args = parser.parse_args()
+  return parser
+
+def parseArgs(argv=None):
+  if argv is None:
+    argv = sys.argv[1:]
+  args = createParser().parse_args(argv)
+  setupArgs(args)
+
+  # A running obmtool serve may have a profile ready. Test runs need their
+  # own jsbridge ports in the profile and always build it here.
+  if args.daemon and not args.mozmill:
+    with tracer.span("daemon.request"):
+      args.prepared = obmtool.daemon.requestProfile(args.socket, argv)
+
+  if args.prepared:
+    with tracer.span("profile.open"):
+      runner = createRunner(args)
+  else:
+    with tracer.span("profile.create"):
+      runner = createRunner(args)
+    with tracer.span("profile.setup"):
+      setupProfile(runner.profile)
+    with tracer.span("caches.save"):
+      obmtool.certificates.cache.save()
+      obmtool.utils.metadata.save()
+
+  return runner, args
+
+def setupArgs(args):
+  """ Completes the parsed arguments from the config, up to the point
+      where the profile can be created.
+  """
+  args.instance = None
+  args.prepared = False
+  args.standIn = False
 
   # Set up logging
   if args.verbose:
     logging.basicConfig(level=logging.INFO)
+  if args.verbose or args.trace:
+    tracer.enable()
 
   # Read user config, this needs to be done fairly early
   if not args.config:
-    args.config = defaultconfig
+    args.config = defaultConfigPath()
   if not os.path.exists(args.config):
     print "Config file %s does not exist" % os.path.abspath(args.config)
     sys.exit(1)
   mode = os.stat(args.config)[stat.ST_MODE]
   logging.info("Reading configuration from %s" % os.path.abspath(args.config))
-  config.readUserFile(args.config)
+  with tracer.span("config.read"):
+    config.readUserFile(args.config)
 
   # Protect from footgun
   if config.get("defaults", "password") and mode & (stat.S_IRGRP | stat.S_IWOTH | stat.S_ISUID | stat.S_ISGID) != 0:
@@ -93,20 +214,35 @@ def parseArgs():
   for k in configdefaults:
     if not k in args.__dict__ or args.__dict__[k] is None:
       args.__dict__[k] = configdefaults[k]
+  if args.verbose:
+    tracer.enable()
 
+  # Set up a path for the profile, either from config or using /tmp
+  args.cachePath = config.get("paths", "profileCache", None)
+  if args.cachePath is None:
+    args.cachePath = tempfile.gettempdir()
+  args.cachePath = os.path.expanduser(args.cachePath)
+
+  # Versions of Thunderbird and the add-ons are remembered between runs
+  metadataCache = config.get("paths", "metadataCache", None)
+  if metadataCache is None:
+    metadataCache = os.path.join(args.cachePath, "metadata.json")
+  with tracer.span("metadata.open"):
+    obmtool.utils.metadata.open(os.path.expanduser(metadataCache))
 
   # Set up the Thunderbird version and path
-  try:
-    # First check if a version number was passed and get the path from the config
-    args.tbversion = int(args.thunderbird)
-    args.thunderbird = os.path.expanduser(config.require("paths", "thunderbird-%s" % args.tbversion))
-    args.thunderbird = obmtool.utils.fixBinaryPath(args.thunderbird)
-  except ValueError:
-    # Otherwise it was probably a path. Keep the path in args.thunderbird and
-    # get the version from Thunderbird's application.ini
-    args.thunderbird = obmtool.utils.fixBinaryPath(os.path.expanduser(args.thunderbird))
-    tbversion = mozversion.get_version(args.thunderbird)['application_version']
-    args.tbversion = int(tbversion.split(".")[0])
+  with tracer.span("thunderbird.version"):
+    try:
+      # First check if a version number was passed and get the path from the config
+      args.tbversion = int(args.thunderbird)
+      args.thunderbird = os.path.expanduser(config.require("paths", "thunderbird-%s" % args.tbversion))
+      args.thunderbird = obmtool.utils.fixBinaryPath(args.thunderbird)
+    except ValueError:
+      # Otherwise it was probably a path. Keep the path in args.thunderbird and
+      # get the version from Thunderbird's application.ini
+      args.thunderbird = obmtool.utils.fixBinaryPath(os.path.expanduser(args.thunderbird))
+      tbversion = obmtool.utils.applicationVersion(args.thunderbird)
+      args.tbversion = int(tbversion.split(".")[0])
 
   # Set up default lightning xpi based on either passed token (i.e tb3) or
   # passed thunderbird version
@@ -128,15 +264,38 @@ def parseArgs():
   logging.info("Using Lighting from %s" % args.lightning)
   logging.info("Using OBM from %s" % args.obm)
 
-  # Set up a path for the profile, either from config or using /tmp
-  args.cachePath = config.get("paths", "profileCache", None)
-  if args.cachePath is None:
-    args.cachePath = tempfile.gettempdir()
+  # The NSS helper environments are cached next to the profiles by default
+  if args.nssCache is None:
+    args.nssCache = config.get("paths", "nssCache", None)
+  if args.nssCache is None:
+    args.nssCache = os.path.join(args.cachePath, "nss")
 
   # Expand user path for later use
   args.obm = os.path.expanduser(args.obm)
   args.lightning = os.path.expanduser(args.lightning)
-  args.cachePath = os.path.expanduser(args.cachePath)
+  args.nssCache = os.path.expanduser(args.nssCache)
+
+  # New profiles are cloned from templates, unless templateCache is empty
+  args.templateCache = config.get("paths", "templateCache", None)
+  if args.templateCache is None:
+    args.templateCache = os.path.join(args.cachePath, "templates")
+  args.templateCache = os.path.expanduser(args.templateCache)
+
+  # Add-ons are unpacked once and linked into profiles, unless addonCache
+  # is empty
+  args.addonCache = config.get("paths", "addonCache", None)
+  if args.addonCache is None:
+    args.addonCache = os.path.join(args.cachePath, "addons")
+  args.addonCache = os.path.expanduser(args.addonCache)
+
+  # Set up the certificate cache, it needs to be open before the profile is
+  # created.
+  certificateCache = config.get("paths", "certificateCache", None)
+  if certificateCache is None:
+    certificateCache = os.path.join(args.cachePath, "certificates.json")
+  obmtool.certificates.cache.open(os.path.expanduser(certificateCache),
+                                  config.get("defaults", "certificateTTL", 86400),
+                                  args.refreshCertificates)
 
   # Add extra addons from prefs and passed options
   extensions = filter(bool, re.split("[,\n]", config.get("profile", "extensions", "")))
@@ -144,28 +303,24 @@ def parseArgs():
   extensions.append(args.obm)
   extensions.append(args.lightning)
   if args.mozmill:
+    import mozmill
     extensions.extend(mozmill.ADDONS)
 
   args.extension = map(os.path.expanduser, extensions)
 
   # Add extra preferences specified on commandline
   extraprefs = {}
-  preferences = config.getAll("preferences")
+  preferences = config.getAll("preferences", [])
   preferences.extend([x.split("=", 2) for x in args.pref])
   for k, v in preferences:
-    lv = v.lower()
-    if lv == "true":
-      v = True
-    elif lv == "false":
-      v = False
-    else:
-      try: v = int(v)
-      except: pass
-    extraprefs[k] = v
+    extraprefs[k] = ObmToolConfig.correctType(v, floats=False)
 
   if args.mozmill:
-    # Set up jsbridge port
-    args.jsbridge_port = jsbridge.find_port()
+    # Set up jsbridge ports, one for each parallel Thunderbird
+    args.jobs = max(args.jobs, 1)
+    args.jsbridge_sockets = reservePorts(args.jobs)
+    args.jsbridge_ports = [sock.getsockname()[1] for sock in args.jsbridge_sockets]
+    args.jsbridge_port = args.jsbridge_ports[0]
 
     # Add testing prefs
     extraprefs['extensions.jsbridge.port'] = args.jsbridge_port
@@ -176,28 +331,17 @@ def parseArgs():
     extraprefs['extensions.obm.syncOnStart'] = False
 
     # Set up mozinfo for our current configuration
-    mozinfo.update(obmtool.utils.setupMozinfo(args))
+    with tracer.span("mozinfo"):
+      mozinfo.update(obmtool.utils.setupMozinfo(args))
 
   # Set up extra preferences in the profile
   args.preferences = extraprefs
 
-  # For the following args we need the runner already
-  runner = createRunner(args)
-
-  # Add extra certificates from the prefs
-  for cert in filter(bool, re.split("[,\n]", config.get("profile", "certificates", ""))):
-    host,port = cert.split(":")
-    runner.profile.overrides.addEntry(host, int(port))
-
-  # Add extra signons from the prefs
-  for signon in filter(bool, re.split("[,\n]", config.get("profile", "signons", ""))):
-    hostname,realm,user,password = signon.split("|")
-    runner.profile.signons.addEntry(hostname, realm, user, password)
-
-  # Need to flush profile after adding certs/signons
-  runner.profile.flush()
-
-  return runner, args
+  # The socket obmtool serve listens on
+  args.socket = config.get("paths", "daemonSocket", None)
+  if args.socket is None:
+    args.socket = os.path.join(args.cachePath, "obmtool.sock")
+  args.socket = os.path.expanduser(args.socket)
 
 def run(runner, args):
   print "Profile for Thunderbird %d created in %s" % (args.tbversion, runner.profile.profile)
@@ -208,22 +352,68 @@ def run(runner, args):
   if args.verbose:
     print runner.profile.summary()
 
-  if args.mozmill:
-    run_mozmill(wrap_mozmill_runner(runner, args), args)
-  else:
-    run_thunderbird(runner, args)
+  if args.mozmill and args.jobs > 1:
+    # Each shard samples its own Thunderbird
+    run_mozmill_parallel(runner, args)
+    return
+
+  sampler = start_sampler(runner, args)
+  try:
+    if args.mozmill:
+      run_mozmill(wrap_mozmill_runner(runner, args), args)
+    else:
+      run_thunderbird(runner, args)
+  finally:
+    finish_sampler(sampler, args.sample)
+
+def runner_pid(runner):
+  # The process handler changes when Thunderbird is restarted
+  handler = getattr(runner, "process_handler", None)
+  return handler.pid if handler else None
+
+def start_sampler(runner, args):
+  if not args.sample:
+    return None
+  if not obmtool.resources.available():
+    print "Resource sampling needs /proc, which this platform doesn't have"
+    return None
+
+  sampler = ResourceSampler(lambda: runner_pid(runner), args.sampleInterval)
+  sampler.begin()
+  return sampler
+
+def finish_sampler(sampler, path):
+  if sampler is None:
+    return
+  sampler.end()
+  sampler.save(path)
+  print sampler.formatPeaks()
+  logging.info("Resource samples written to %s" % path)
+
+def create_report(args):
+  from obmtool.report import JUnitReport
+
+  class Testrun(object):
+    report_type = 'obm-mozmill'
+  return JUnitReport(args.logfile, Testrun())
+
+def wrap_mozmill_runner(runner, args, report=True, logfile=None):
+  import mozmill
+  import mozmill.logger
 
-def wrap_mozmill_runner(runner, args):
   handlers = []
   level = "DEBUG" if args.verbose else "INFO"
   llevel = logging.DEBUG if args.verbose else logging.INFO
 
+  # Adds the resources used by each test to its result, before the report
+  # and loggers get it
+  if obmtool.resources.available():
+    handlers.append(TestResources(lambda: runner_pid(runner)))
+
   if args.format == "xunit":
     # Output to logfile as xunit
-    class Testrun(object):
-      report_type = 'obm-mozmill'
-    reportHandler = JUnitReport(args.logfile, Testrun())
-    handlers.append(reportHandler)
+    if report:
+      handlers.append(create_report(args))
 
     # Also output to the console
     logformat = "pprint-color" if sys.stdout.isatty() else "pprint"
@@ -233,13 +423,16 @@ def wrap_mozmill_runner(runner, args):
   else:
     # Otherwise set up the combined console/file logger
     loghandler = mozmill.logger.LoggerListener(format=args.format,console_level=level,
-                                               file_level=level, log_file=args.logfile)
+                                               file_level=level, log_file=logfile or args.logfile)
     loghandler.logger.setLevel(llevel)
     handlers.append(loghandler)
 
   return mozmill.MozMill(runner, args.jsbridge_port, handlers=handlers)
 
-def run_mozmill(runner, args):
+def collect_tests(args):
+  from manifestparser import TestManifest
+  import mozmill
+
   tests = []
   for test in args.mozmill:
     testpath = os.path.expanduser(test)
@@ -267,39 +460,239 @@ def run_mozmill(runner, args):
     print "Running these tests:"
     print "\t" + "\n\t".join(map(lambda x: x['path'], tests))
 
+  return tests
+
+def open_timings(args):
+  path = config.get("paths", "timingDatabase", None)
+  if path is None:
+    path = os.path.join(args.cachePath, "timings.sqlite")
+  if not path:
+    return None
+  return TimingDatabase(os.path.expanduser(path))
+
+def schedule_tests(tests, jobs, timings):
+  if timings is None:
+    return [tests[i::jobs] for i in range(jobs)], None
+
+  versions = TimingDatabase.versions(mozinfo.info)
+  estimates = dict((test['path'], timings.estimate(os.path.realpath(test['path']), versions))
+                   for test in tests)
+  return schedule(tests, jobs, estimates)
+
+def record_timings(timings, results, predicted, actual):
+  if timings is None:
+    return
+  timings.record(testDurations(results), TimingDatabase.versions(mozinfo.info))
+  timings.close()
+  # Without tests there are no shards to report on
+  if predicted and actual:
+    print makespanReport(predicted, actual)
+
+def run_mozmill(runner, args):
+  timings = open_timings(args)
+  [tests], predicted = schedule_tests(collect_tests(args), 1, timings)
+
   exception = None
+  start = time.time()
+  releasePorts(args)
   try:
     runner.run(tests, True)
   except:
     exception_type, exception, tb = sys.exc_info()
 
   results = runner.finish(fatal=exception is not None)
+  record_timings(timings, results, predicted, [time.time() - start])
 
   if exception:
       traceback.print_exception(exception_type, exception, tb)
   if exception or results.fails:
       sys.exit(1)
 
+class ShardResults(object):
+  """ Mozmill results merged from the shards of a parallel run. """
+
+  def __init__(self):
+    self.alltests = []
+    self.passes = []
+    self.fails = []
+    self.skipped = []
+    self.starttime = None
+    self.endtime = None
+
+  def add(self, data):
+    for key, value in data.iteritems():
+      if key not in self.__dict__:
+        setattr(self, key, value)
+
+    if data.get('starttime') and (not self.starttime or data['starttime'] < self.starttime):
+      self.starttime = data['starttime']
+    if data.get('endtime') and (not self.endtime or data['endtime'] > self.endtime):
+      self.endtime = data['endtime']
+
+    for test in data.get('alltests', []):
+      self.addTest(test)
+
+  def addTest(self, test):
+    self.alltests.append(test)
+    if test.get('skipped'):
+      self.skipped.append(test)
+    elif test.get('failed'):
+      self.fails.append(test)
+    else:
+      self.passes.append(test)
+
+def run_mozmill_shard(index, tests, runner, args, queue):
+  # The shard inherits all reservations. Its own port stays reserved while
+  # the profile is built and is only freed for Thunderbird to bind it.
+  releasePorts(args, [i for i in range(len(args.jsbridge_sockets)) if i != index])
+  try:
+    shardArgs = copy.copy(args)
+    if runner is None:
+      # Each further shard gets its own profile and jsbridge port
+      shardArgs.instance = index
+      shardArgs.jsbridge_port = args.jsbridge_ports[index]
+      shardArgs.preferences = dict(args.preferences)
+      shardArgs.preferences['extensions.jsbridge.port'] = shardArgs.jsbridge_port
+      runner = createRunner(shardArgs)
+      setupProfile(runner.profile)
+
+    logfile = None
+    if args.logfile:
+      logfile = "%s.%d" % (args.logfile, index)
+    mozmillRunner = wrap_mozmill_runner(runner, shardArgs, report=False, logfile=logfile)
+
+    sampler = start_sampler(runner, args)
+    exception = None
+    start = time.time()
+    releasePorts(args, [index])
+    try:
+      mozmillRunner.run(tests, True)
+    except:
+      exception = traceback.format_exc()
+    results = mozmillRunner.finish(fatal=exception is not None)
+    elapsed = time.time() - start
+    if sampler:
+      root, ext = os.path.splitext(args.sample)
+      finish_sampler(sampler, "%s.%d%s" % (root, index, ext))
+
+    # Only send what survives the trip to the parent process
+    data = {}
+    for key, value in vars(results).iteritems():
+      try:
+        pickle.dumps(value)
+        data[key] = value
+      except Exception:
+        pass
+    queue.put((index, data, exception, elapsed))
+  except:
+    queue.put((index, None, traceback.format_exc(), None))
+
+def run_mozmill_parallel(runner, args):
+  # Distribute the tests using the durations of earlier runs, if known
+  timings = open_timings(args)
+  shards, predicted = schedule_tests(collect_tests(args), args.jobs, timings)
+  if predicted:
+    predicted = [p for p, shard in zip(predicted, shards) if len(shard)]
+  shards = filter(len, shards)
+  start = time.time()
+
+  # Every shard runs in its own process, so that a crashing Thunderbird or
+  # mozmill only takes down its own shard. The first shard reuses the
+  # profile that was already created.
+  queue = multiprocessing.Queue()
+  processes = []
+  for index, shard in enumerate(shards):
+    process = multiprocessing.Process(target=run_mozmill_shard,
+                                      args=(index, shard, runner if index == 0 else None,
+                                            args, queue))
+    process.start()
+    processes.append(process)
+  # The shards hold their own copies of the reservations
+  releasePorts(args)
+
+  replies = {}
+  while len(replies) < len(processes):
+    try:
+      index, data, error, elapsed = queue.get(timeout=1)
+      replies[index] = (data, error, elapsed)
+    except Queue.Empty:
+      if not any(process.is_alive() for process in processes) and queue.empty():
+        break
+
+  for process in processes:
+    process.join()
+
+  results = ShardResults()
+  failed = False
+  actual = []
+  for index, shard in enumerate(shards):
+    data, error, elapsed = replies.get(index, (None, "Shard process exited with code %s" % processes[index].exitcode, None))
+    actual.append(time.time() - start if elapsed is None else elapsed)
+    if data:
+      results.add(data)
+    if error:
+      failed = True
+      print "Shard %d failed:\n%s" % (index, error)
+      if not data:
+        results.addTest({
+          'name': 'shard %d' % index,
+          'filename': 'shard-%d' % index,
+          'passed': 0,
+          'failed': 1,
+          'fails': [{ 'exception': {
+            'message': 'Shard crashed while running %s' % ", ".join(t['path'] for t in shard),
+            'stack': error
+          }}]
+        })
+
+  if args.format == "xunit":
+    create_report(args).stop(results, failed)
+  record_timings(timings, results, predicted, actual)
+
+  print "Parallel run finished: %d passed, %d failed, %d skipped in %d shards" % (
+    len(results.passes), len(results.fails), len(results.skipped), len(shards))
+
+  if failed or results.fails:
+      sys.exit(1)
+
+def export_sync_stats(parser, runner, args, sessionStart):
+  # The sync statistics of each session are kept in syncStats, unless it is
+  # set to an empty value
+  statsDir = config.get("paths", "syncStats", None)
+  if statsDir is None:
+    statsDir = os.path.join(args.cachePath, "syncstats")
+  if not statsDir:
+    return
+
+  statsDir = os.path.expanduser(statsDir)
+  if not os.path.isdir(statsDir):
+    os.makedirs(statsDir)
+  filename = "%s-%s.json" % (runner.profile.profileName,
+                             time.strftime("%Y%m%d-%H%M%S", sessionStart))
+  parser.export(os.path.join(statsDir, filename))
+  logging.info("Sync statistics written to %s" % os.path.join(statsDir, filename))
+
 def run_thunderbird(runner, args):
   if not os.path.exists(runner.profile.connectorLog):
     fp = open(runner.profile.connectorLog, "a")
     fp.close()
-  logfile = open(runner.profile.connectorLog)
+  follower = LogFollower(runner.profile.connectorLog)
   restartMode = config.get("defaults", "restart", False)
   try:
     while True:
       print "Starting Thunderbird..."
       runner.start()
-      logfile.seek(os.stat(runner.profile.connectorLog)[6])
+      follower.seekEnd()
+      parser = ConnectorLogParser.fromConfig(config)
+      sessionStart = time.localtime()
 
-      while runner.is_running():
-        where = logfile.tell()
-        line = logfile.readline()
-        if line:
+      for lines in follower.follow(runner.is_running):
+        parser.feedLines(lines)
+        for line in lines:
           print "Connector:",line.rstrip()
-        else:
-          runner.wait(1)
-          logfile.seek(where)
+
+      print parser.formatSummary()
+      export_sync_stats(parser, runner, args, sessionStart)
 
       if restartMode is True or restartMode == "prompt":
         raw_input("\nRestart? (Ctrl-C to cancel)")
@@ -312,10 +705,29 @@ def run_thunderbird(runner, args):
     print "\nCleaning up..."
     runner.cleanup()
   finally:
-    logfile.close()
+    follower.close()
+
+def finish_trace(args):
+  if args.trace:
+    tracer.save(args.trace)
+    logging.info("Startup trace written to %s" % args.trace)
+  if args.verbose:
+    print tracer.summary()
+
+# Subcommands, any other command line starts Thunderbird
+COMMANDS = {
+  "serve": obmtool.daemon.serve,
+  "provision": obmtool.provision.provision,
+  "load": obmtool.loadtest.load
+}
 
 def main():
+  if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+    COMMANDS[sys.argv[1]](sys.argv[2:])
+    return
+
   runner, args = parseArgs()
+  finish_trace(args)
   run(runner, args)
 
 if __name__ == "__main__":
@@ -0,0 +1,724 @@
+#!/usr/bin/env python
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from base64 import b64encode, b64decode
+from collections import OrderedDict
+import argparse
+import datetime
+import fnmatch
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARKS = OrderedDict()
+
+def benchmark(name):
+  """ Registers a benchmark. The function is called with the scale and a
+      scratch directory and returns the function to time, or a (setup, run)
+      tuple where run is called with the result of setup. If the function
+      returns a number, it is used as the time taken instead.
+  """
+  def decorator(fn):
+    BENCHMARKS[name] = fn
+    return fn
+  return decorator
+
+class StubNSSSession(object):
+  """ Stands in for an NSS session, so that no Thunderbird is needed. """
+
+  def start(self):
+    pass
+  def stop(self):
+    pass
+
+  def encrypt_many(self, values):
+    return [b64encode(x.encode("utf-8") if isinstance(x, unicode) else x) for x in values]
+  def decrypt_many(self, values):
+    return [b64decode(x) for x in values]
+
+def signonEntries(count):
+  from obmtool.signons import SignonFileEntry
+  return [SignonFileEntry("https://host%d.example.com" % i, "OBM realm %d" % (i % 10),
+                          "user%d" % i, "password%d" % i)
+          for i in xrange(count)]
+
+def certificateLines(count):
+  fingerprint = ":".join(["AB"] * 32)
+  issuerSerialHash = "  ".join(["A" * 64, "B" * 64, "C" * 20])
+  return ["host%d.example.com:%d\tOID.2.16.840.1.101.3.4.2.1\t%s\tU\t%s" %
+          (i, 443 + i % 2, fingerprint, issuerSerialHash) for i in xrange(count)]
+
+def mozmillResults(count):
+  results = []
+  for i in xrange(count):
+    result = { 'filename': '/tmp/tests/obm-mozmill/dir%d/test_%d.js' % (i % 50, i),
+               'name': 'test_%d.js::testFunction%d' % (i, i),
+               'time_start': 0, 'time_end': 1500, 'failed': i % 10 == 0 }
+    if i % 10 == 0:
+      result['fails'] = [{ 'exception': { 'message': 'Failure <%d>' % i,
+                                          'stack': 'stack line\n' * 10 } }]
+    elif i % 25 == 0:
+      result['skipped'] = True
+      result['skipped_reason'] = 'Skipped on this platform'
+    results.append(result)
+  return results
+
+@benchmark("signons3.read")
+def signons3Read(scale, tmpdir):
+  from obmtool.signons import Signons3File
+  path = os.path.join(tmpdir, "signons3.txt")
+  signons = Signons3File(path)
+  signons.addEntries(signonEntries(5000 * scale))
+  signons.write()
+  return lambda: Signons3File(path)
+
+@benchmark("signons3.write")
+def signons3Write(scale, tmpdir):
+  from obmtool.signons import Signons3File
+  signons = Signons3File(os.path.join(tmpdir, "signons3-write.txt"))
+  signons.addEntries(signonEntries(5000 * scale))
+  def run():
+    signons.dirty = True
+    signons.write()
+  return run
+
+@benchmark("signonssql.addEntries")
+def signonsSQLAddEntries(scale, tmpdir):
+  from obmtool.signons import SignonsSQLFile
+  entries = signonEntries(1000 * scale)
+  counter = [0]
+  def setup():
+    counter[0] += 1
+    path = os.path.join(tmpdir, "signons-%d.sqlite" % counter[0])
+    return SignonsSQLFile(tmpdir, tmpdir, path, nssSession=StubNSSSession())
+  def run(signons):
+    signons.addEntries(entries)
+    signons.write()
+    signons.close()
+  return setup, run
+
+@benchmark("signonssql.reprovision")
+def signonsSQLReprovision(scale, tmpdir):
+  from obmtool.signons import SignonsSQLFile, SignonFileEntry
+  # Every tenth login has no realm, which is stored as NULL
+  entries = [SignonFileEntry(entry.hostname, entry.httpRealm if i % 10 else None,
+                             entry.user, entry.password)
+             for i, entry in enumerate(signonEntries(5000 * scale))]
+  changed = [SignonFileEntry(entry.hostname, entry.httpRealm, entry.user,
+                             entry.password + ("-new" if i % 3 else ""))
+             for i, entry in enumerate(entries)]
+  counter = [0]
+  def setup():
+    counter[0] += 1
+    path = os.path.join(tmpdir, "signons-reprovision-%d.sqlite" % counter[0])
+    return SignonsSQLFile(tmpdir, tmpdir, path, nssSession=StubNSSSession())
+  def run(signons):
+    # Writing the same logins again must update them, not add rows
+    signons.addEntries(entries)
+    signons.addEntries(changed)
+    signons.write()
+    count = signons.conn.execute("SELECT COUNT(*) FROM moz_logins").fetchone()[0]
+    nulls = signons.conn.execute("""SELECT COUNT(*) FROM moz_logins
+                                     WHERE httpRealm IS NULL""").fetchone()[0]
+    signons.close()
+    if count != len(entries) or nulls != len(entries) // 10:
+      raise RuntimeError("moz_logins has %d rows, %d without realm, expected %d and %d" %
+                         (count, nulls, len(entries), len(entries) // 10))
+  return setup, run
+
+def nssBinPath():
+  """ The directory of the NSS libraries of the default Thunderbird in the
+      user's config, the NSS benchmarks are skipped without one.
+  """
+  from obmtool.app import defaultConfigPath
+  from obmtool.config import ObmToolConfig
+  from obmtool.nss import NSSSession
+  from obmtool.utils import fixBinaryPath
+  config = ObmToolConfig()
+  if os.path.exists(defaultConfigPath()):
+    config.readUserFile(defaultConfigPath())
+  version = config.get("defaults", "tbversion", None)
+  binary = config.get("paths", "thunderbird-%s" % version, None) if version else None
+  if not binary:
+    raise ImportError("no Thunderbird configured in paths.thunderbird-<tbversion>")
+  binPath = os.path.dirname(fixBinaryPath(os.path.expanduser(binary)))
+  try:
+    NSSSession.libraryFiles(binPath)
+  except Exception, e:
+    raise ImportError(str(e))
+  return binPath
+
+def nssStartup(createSession, tmpdir):
+  """ Times starting a session on a new key database and encrypting one
+      value, which is what setting up the signons of a profile costs.
+  """
+  def setup():
+    return createSession(tempfile.mkdtemp(prefix="nss-profile-", dir=tmpdir))
+
+  def run(session):
+    try:
+      session.encrypt("password")
+    finally:
+      session.stop()
+
+  # Start once up front, so that the helper environment is cached and the
+  # timed runs see warm caches.
+  run(setup())
+  return setup, run
+
+@benchmark("nss.inprocess")
+def nssInProcess(scale, tmpdir):
+  from obmtool.nss import InProcessNSSSession
+  binPath = nssBinPath()
+  if not InProcessNSSSession.supported(binPath):
+    raise ImportError("the NSS libraries in %s do not match this interpreter" % binPath)
+  return nssStartup(lambda profilePath: InProcessNSSSession(binPath, profilePath), tmpdir)
+
+@benchmark("nss.helper")
+def nssHelper(scale, tmpdir):
+  from obmtool.nss import NSSSession
+  import virtualenv
+  binPath = nssBinPath()
+  cacheDir = os.path.join(tmpdir, "nss-cache")
+  return nssStartup(lambda profilePath: NSSSession(binPath, profilePath,
+                                                   cacheDir=cacheDir), tmpdir)
+
+@benchmark("certoverride.read")
+def certOverrideRead(scale, tmpdir):
+  from obmtool.certificates import CertOverrideFile
+  path = os.path.join(tmpdir, "cert_override.txt")
+  with open(path, "w") as fp:
+    fp.write("# PSM Certificate Override Settings file\n")
+    fp.write("\n".join(certificateLines(5000 * scale)) + "\n")
+  return lambda: CertOverrideFile(path)
+
+@benchmark("certoverride.str")
+def certOverrideStr(scale, tmpdir):
+  from obmtool.certificates import CertOverrideFile
+  overrides = CertOverrideFile(os.path.join(tmpdir, "cert_override-str.txt"))
+  overrides.read(certificateLines(5000 * scale))
+  return lambda: str(overrides)
+
+def selfSignedCertificate(tmpdir):
+  certfile = os.path.join(tmpdir, "server.pem")
+  if not os.path.exists(certfile):
+    with open(os.devnull, "w") as devnull:
+      try:
+        code = subprocess.call(["openssl", "req", "-x509", "-newkey", "rsa:2048",
+                                "-nodes", "-days", "1", "-subj", "/CN=localhost",
+                                "-keyout", certfile, "-out", certfile],
+                               stdout=devnull, stderr=devnull)
+      except OSError:
+        code = None
+    if code != 0:
+      raise ImportError("openssl is needed to create a test certificate")
+  return certfile
+
+def tlsServer(certfile, handshake=True):
+  """ A local TLS server that answers handshakes, or one that accepts
+      connections but never answers. Returns the listening socket.
+  """
+  import socket
+  import ssl
+  listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  listener.bind(("127.0.0.1", 0))
+  listener.listen(16)
+
+  def serve():
+    while True:
+      try:
+        conn = listener.accept()[0]
+      except Exception:
+        return
+      if not handshake:
+        # Keep the connection open and silent until the listener is closed
+        continue
+      try:
+        ssl.wrap_socket(conn, server_side=True, certfile=certfile).close()
+      except Exception:
+        conn.close()
+
+  if handshake:
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+  return listener
+
+@benchmark("certificates.addEntries")
+def certificatesAddEntries(scale, tmpdir):
+  import socket
+  from obmtool.certificates import CertOverrideFile
+  certfile = selfSignedCertificate(tmpdir)
+  timeout = 1.0
+
+  # Two servers that answer, two that never finish the handshake and a port
+  # nobody listens on. The silent ones don't accept, the connections wait
+  # in the backlog.
+  servers = [tlsServer(certfile), tlsServer(certfile),
+             tlsServer(certfile, False), tlsServer(certfile, False)]
+  closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  closed.bind(("127.0.0.1", 0))
+  refused = closed.getsockname()[1]
+  closed.close()
+
+  counter = [0]
+
+  def run():
+    # The servers are used here, so that they stay open as long as run
+    hosts = [("127.0.0.1", server.getsockname()[1]) for server in servers]
+    hosts.append(("127.0.0.1", refused))
+    counter[0] += 1
+    overrides = CertOverrideFile(os.path.join(tmpdir, "cert_override-%d.txt" % counter[0]))
+    start = time.time()
+    failures = overrides.addEntries(hosts, timeout=timeout, jobs=8)
+    elapsed = time.time() - start
+
+    failed = sorted(port for host, port, error in failures)
+    expected = sorted([hosts[2][1], hosts[3][1], refused])
+    if failed != expected or len(overrides.entries) != 2:
+      raise RuntimeError("Expected failures for ports %s and 2 entries, got %s and %d" %
+                         (expected, failed, len(overrides.entries)))
+    # The hosts are fetched concurrently, so the slow ones cost one timeout
+    if elapsed > timeout * 1.8:
+      raise RuntimeError("Fetching took %.1fs, more than one %.1fs timeout" % (elapsed, timeout))
+    return elapsed
+  return run
+
+@benchmark("profile.templateKey")
+def profileTemplateKey(scale, tmpdir):
+  import zipfile
+  import obmtool.addons
+  from obmtool.profile import ObmProfile
+  addons = []
+  for i in xrange(3):
+    path = os.path.join(tmpdir, "addon%d.xpi" % i)
+    with zipfile.ZipFile(path, "w") as xpi:
+      xpi.writestr("install.rdf", "<RDF/>")
+      xpi.writestr("content/data.js", os.urandom(1 << 20))
+    addons.append(path)
+
+  # obmtool serve computes the key for every request, the xpis should only
+  # be read the first time
+  hashed = []
+  hashPath = obmtool.addons.hashPath
+  def countingHashPath(path):
+    hashed.append(path)
+    return hashPath(path)
+
+  def run():
+    obmtool.addons.hashPath = countingHashPath
+    try:
+      for i in xrange(100 * scale):
+        ObmProfile.templateKey("user", "password", "https://obm.example.com/",
+                               24, "/opt/thunderbird/thunderbird", addons,
+                               {"mail.check_all_imap_folders_for_new": True})
+    finally:
+      obmtool.addons.hashPath = hashPath
+    if len(hashed) > len(addons):
+      raise RuntimeError("Hashed the add-ons %d times for %d keys" % (len(hashed), 100 * scale))
+  return run
+
+HOLD_SCRIPT = """
+import fcntl, os, sys
+fcntl.flock(os.open(sys.argv[1], os.O_RDONLY), fcntl.LOCK_SH)
+sys.stdout.write("locked\\n")
+sys.stdout.flush()
+sys.stdin.read()
+"""
+
+@benchmark("cache.store")
+def cacheStore(scale, tmpdir):
+  import fcntl
+  from obmtool.cache import DirectoryCache
+  counter = [0]
+
+  def build(path):
+    with open(os.path.join(path, "data"), "w") as fp:
+      fp.write("x" * 4096)
+
+  def setup():
+    # Another process is using the oldest entry while the others are stored
+    counter[0] += 1
+    cache = DirectoryCache(os.path.join(tmpdir, "cache-%d" % counter[0]), 4)
+    held = cache.store("held", build)
+    os.utime(held, (0, 0))
+    holder = subprocess.Popen([sys.executable, "-c", HOLD_SCRIPT, held],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    holder.stdout.readline()
+    return cache, holder
+
+  def run(arg):
+    cache, holder = arg
+    try:
+      for i in xrange(100 * scale):
+        cache.store("entry%d" % i, build)
+    finally:
+      holder.communicate()
+    entries = os.listdir(cache.root)
+    if "held" not in entries or len(entries) != cache.maxEntries:
+      raise RuntimeError("Expected the held entry and %d in total, got %s" %
+                         (cache.maxEntries, sorted(entries)))
+  return setup, run
+
+@benchmark("junit.get_report")
+def junitGetReport(scale, tmpdir):
+  from obmtool.report import JUnitReport
+  class Testrun(object):
+    report_type = 'obm-mozmill'
+  class Results(object):
+    alltests = mozmillResults(100000 * scale)
+    starttime = datetime.datetime(2014, 1, 1)
+    endtime = datetime.datetime(2014, 1, 1, 1)
+  report = JUnitReport(os.path.join(tmpdir, "junit-report.xml"), Testrun())
+  return lambda: report.get_report(Results)
+
+@benchmark("junit.stream")
+def junitStream(scale, tmpdir):
+  from obmtool.report import JUnitReport
+  class Testrun(object):
+    report_type = 'obm-mozmill'
+  class Results(object):
+    alltests = []
+    starttime = datetime.datetime(2014, 1, 1)
+    endtime = datetime.datetime(2014, 1, 1, 1)
+  results = mozmillResults(100000 * scale)
+  def run():
+    report = JUnitReport(os.path.join(tmpdir, "junit.xml"), Testrun())
+    for result in results:
+      report.end_test(result)
+    report.stop(Results, False)
+  return run
+
+@benchmark("config.get")
+def configGet(scale, tmpdir):
+  from obmtool.config import ObmToolConfig
+  path = os.path.join(tmpdir, "obmtoolrc")
+  with open(path, "w") as fp:
+    for section in ("defaults", "paths", "profile", "preferences"):
+      fp.write("[%s]\n" % section)
+      for i in xrange(200):
+        fp.write("key%d=%s\n" % (i, ["value %d" % i, str(i), "true", "1.5"][i % 4]))
+      # Keys are case insensitive, iniparse lists them in lower case
+      fp.write("camelCaseKey=%s\n" % section)
+  config = ObmToolConfig()
+  config.readUserFile(path)
+  for section in ("defaults", "paths"):
+    for key in ("camelCaseKey", "camelcasekey", "CAMELCASEKEY"):
+      if config.get(section, key) != section:
+        raise RuntimeError("config.get(%r, %r) returned %r" % (section, key, config.get(section, key)))
+  keys = [("paths", "key%d" % (i % 200)) for i in xrange(10000 * scale)]
+  keys.append(("paths", "missing"))
+  def run():
+    for section, key in keys:
+      config.get(section, key)
+  return run
+
+@benchmark("config.getAll")
+def configGetAll(scale, tmpdir):
+  from obmtool.config import ObmToolConfig
+  path = os.path.join(tmpdir, "obmtoolrc-all")
+  with open(path, "w") as fp:
+    fp.write("[preferences]\n")
+    for i in xrange(200):
+      fp.write("pref.%d=%d\n" % (i, i))
+  config = ObmToolConfig()
+  config.readUserFile(path)
+  def run():
+    for i in xrange(100 * scale):
+      config.getAll("preferences")
+  return run
+
+@benchmark("utils.createVersionProps")
+def createVersionProps(scale, tmpdir):
+  from obmtool.utils import createVersionProps
+  versions = ["24.%d.%d" % (i % 10, i % 3) for i in xrange(10000 * scale)]
+  def run():
+    for version in versions:
+      createVersionProps(version, "tb")
+  return run
+
+@benchmark("prefs.read")
+def prefsRead(scale, tmpdir):
+  from obmtool.prefs import PrefsFile
+  path = os.path.join(tmpdir, "prefs.js")
+  prefs = PrefsFile(path)
+  prefs.update([("extensions.obm.pref%d" % i, [True, i, "value %d" % i][i % 3])
+                for i in xrange(2000 * scale)])
+  prefs.write()
+  return lambda: PrefsFile(path)
+
+@benchmark("prefs.write")
+def prefsWrite(scale, tmpdir):
+  from obmtool.prefs import PrefsFile
+  prefs = PrefsFile(os.path.join(tmpdir, "prefs-write.js"))
+  prefs.update([("extensions.obm.pref%d" % i, [True, i, "value %d" % i][i % 3])
+                for i in xrange(2000 * scale)])
+  def run():
+    prefs.dirty = True
+    prefs.write()
+  return run
+
+@benchmark("logparser.feed")
+def logParserFeed(scale, tmpdir):
+  from obmtool.logparser import ConnectorLogParser
+  lines = []
+  for i in xrange(1000 * scale):
+    lines.extend([
+      "2014-01-01 10:00:%02d Synchronization started" % (i % 60),
+      "2014-01-01 10:00:%02d Starting sync of calendar: home" % (i % 60),
+      "2014-01-01 10:00:%02d Sending request to the server" % (i % 60),
+      "2014-01-01 10:00:%02d Finished sync of calendar: home" % (i % 60),
+      "2014-01-01 10:00:%02d Some other message" % (i % 60),
+      "2014-01-01 10:00:%02d Synchronization finished" % (i % 60)
+    ])
+  def run():
+    parser = ConnectorLogParser()
+    parser.feedLines(lines)
+    parser.summary()
+  return run
+
+def followLatency(scale, tmpdir, inotify):
+  """ Appends lines to a log while it is followed and returns the average
+      time from writing a line to LogFollower.follow delivering it.
+  """
+  from obmtool.logfollower import LogFollower
+  path = tempfile.mkstemp(prefix="connector-log-", dir=tmpdir)[1]
+  count = 50 * scale
+
+  def write():
+    with open(path, "a", 0) as fp:
+      for i in xrange(count):
+        fp.write("%d %.6f\n" % (i, time.time()))
+        time.sleep(0.01)
+
+  follower = LogFollower(path)
+  if inotify and not follower.watch:
+    follower.close()
+    raise ImportError("inotify is not available")
+  elif not inotify and follower.watch:
+    follower.watch.close()
+    follower.watch = None
+
+  latencies = []
+  try:
+    writer = threading.Thread(target=write)
+    writer.start()
+    for lines in follower.follow(writer.is_alive):
+      now = time.time()
+      for line in lines:
+        index, written = line.split()
+        if int(index) != len(latencies):
+          raise RuntimeError("Got line %s, expected line %d" % (index, len(latencies)))
+        latencies.append(now - float(written))
+    writer.join()
+  finally:
+    follower.close()
+
+  if len(latencies) != count:
+    raise RuntimeError("Got %d of %d lines" % (len(latencies), count))
+  return sum(latencies) / len(latencies)
+
+@benchmark("logfollower.inotify")
+def logFollowerInotify(scale, tmpdir):
+  return lambda: followLatency(scale, tmpdir, True)
+
+@benchmark("logfollower.poll")
+def logFollowerPoll(scale, tmpdir):
+  return lambda: followLatency(scale, tmpdir, False)
+
+@benchmark("loadtest.standIn")
+def loadtestStandIn(scale, tmpdir):
+  import urllib2
+  from obmtool.loadtest import StandInServer, allowedInstances, parseRamp
+
+  ramp = parseRamp("5@60, 2@0,50@120")
+  expected = [(0, 2), (30, 2), (60, 5), (119, 5), (120, 10), (600, 10)]
+  for elapsed, count in expected:
+    if allowedInstances(ramp, elapsed, 10) != count:
+      raise RuntimeError("allowedInstances(%s, %s, 10) returned %s, expected %s" %
+                         (ramp, elapsed, allowedInstances(ramp, elapsed, 10), count))
+  if allowedInstances([], 0, 10) != 10:
+    raise RuntimeError("Without a ramp all instances should be allowed")
+
+  count = 20 * scale
+
+  def run():
+    standIn = StandInServer(0, body="<ok/>")
+    standIn.start()
+    try:
+      for i in xrange(count):
+        reply = urllib2.urlopen(standIn.uri + "/login/doLogin?i=%d" % i)
+        if reply.read() != "<ok/>":
+          raise RuntimeError("Unexpected reply from the stand-in server")
+        urllib2.urlopen(urllib2.Request(standIn.uri + "/calendar/sync", "data")).read()
+    finally:
+      standIn.stop()
+
+    summary = standIn.summary()
+    paths = dict(summary["paths"])
+    expectedPaths = { "GET /obm-sync/login/doLogin": count,
+                      "POST /obm-sync/calendar/sync": count }
+    if summary["requests"]["count"] != 2 * count or paths != expectedPaths:
+      raise RuntimeError("Stand-in server counted %d requests, %s" %
+                         (summary["requests"]["count"], paths))
+  return run
+
+# Modules a launch without -m should not load, see obmtool.app. mozprofile
+# imports manifestparser itself, and every launch needs mozprofile.
+LAZY_MODULES = ("mozmill", "jsbridge", "M2Crypto", "virtualenv")
+
+IMPORT_SCRIPT = """
+import sys, time
+start = time.time()
+try:
+  import obmtool.app
+except ImportError, e:
+  print "ImportError: %%s" %% e
+  sys.exit(2)
+print time.time() - start
+print ",".join(x for x in %r if x in sys.modules)
+""" % (LAZY_MODULES,)
+
+@benchmark("import.app")
+def importApp(scale, tmpdir):
+  env = dict(os.environ)
+  root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  env["PYTHONPATH"] = os.pathsep.join(filter(bool, [root, env.get("PYTHONPATH")]))
+
+  def run():
+    process = subprocess.Popen([sys.executable, "-c", IMPORT_SCRIPT], env=env,
+                               stdout=subprocess.PIPE)
+    output = process.communicate()[0].splitlines()
+    if process.returncode == 2:
+      raise ImportError(output[-1].partition(": ")[2])
+    elif process.returncode:
+      raise RuntimeError("Importing obmtool.app failed")
+
+    eager = filter(bool, output[1].split(","))
+    if eager:
+      raise RuntimeError("obmtool.app imports %s at startup" % ", ".join(eager))
+    return float(output[0])
+
+  # Import once up front, so that skipping and failures are reported before
+  # timing and the timed runs see warm caches.
+  run()
+  return run
+
+def measure(fn, repeat):
+  if isinstance(fn, tuple):
+    setup, run = fn
+  else:
+    setup, run = None, fn
+
+  timings = []
+  for i in xrange(repeat):
+    arg = setup() if setup else None
+    start = time.time()
+    if setup:
+      taken = run(arg)
+    else:
+      taken = run()
+    if not isinstance(taken, float):
+      taken = time.time() - start
+    timings.append(taken)
+  timings.sort()
+  return OrderedDict([("min", timings[0]), ("median", timings[len(timings) // 2])])
+
+def runBenchmarks(names, scale, repeat):
+  results = OrderedDict()
+  failures = []
+  tmpdir = tempfile.mkdtemp(prefix="obmtool-benchmark-")
+  try:
+    for name in names:
+      try:
+        fn = BENCHMARKS[name](scale, tmpdir)
+        results[name] = measure(fn, repeat)
+      except ImportError, e:
+        print "%-28s skipped: %s" % (name, e)
+        continue
+      except Exception, e:
+        print "%-28s failed: %s" % (name, e)
+        failures.append(name)
+        continue
+      print formatResult(name, results[name])
+  finally:
+    shutil.rmtree(tmpdir, True)
+  return results, failures
+
+def formatResult(name, result, baseline=None):
+  line = "%-28s %10.2fms %10.2fms" % (name, result["min"] * 1000, result["median"] * 1000)
+  if baseline:
+    line += " %10.2fms %+7.1f%%" % (baseline["median"] * 1000,
+                                    (result["median"] / baseline["median"] - 1) * 100)
+  return line
+
+def compare(results, baseline, threshold):
+  """ Prints the results next to the baseline, returns the names of the
+      benchmarks whose median got slower by more than threshold.
+  """
+  regressions = []
+  print
+  print "%-28s %12s %12s %12s %8s" % ("Benchmark", "min", "median", "baseline", "change")
+  for name, result in results.iteritems():
+    reference = baseline["results"].get(name)
+    print formatResult(name, result, reference)
+    if reference and result["median"] > reference["median"] * (1 + threshold):
+      regressions.append(name)
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark obmtool's file formats and report generation")
+  parser.add_argument('-k', '--filter', type=str, default="*", metavar='PATTERN', help="Only run the benchmarks matching PATTERN (default: all)")
+  parser.add_argument('-s', '--scale', type=int, default=1, help="Multiply the size of the synthetic inputs (default: 1)")
+  parser.add_argument('-r', '--repeat', type=int, default=5, help="Number of times to run each benchmark (default: 5)")
+  parser.add_argument('--save', type=str, default=None, metavar='FILE', help="Save the results as a baseline to FILE")
+  parser.add_argument('--compare', type=str, default=None, metavar='FILE', help="Compare the results with the baseline in FILE")
+  parser.add_argument('--threshold', type=float, default=0.1, help="Fraction a median may get slower than the baseline before it counts as a regression (default: 0.1)")
+  parser.add_argument('-l', '--list', action='store_true', help="List the benchmarks and exit")
+  args = parser.parse_args()
+
+  names = [x for x in BENCHMARKS if fnmatch.fnmatch(x, args.filter)]
+  if args.list:
+    print "\n".join(names)
+    return
+
+  baseline = None
+  if args.compare:
+    with open(args.compare) as fp:
+      baseline = json.load(fp)
+    if baseline.get("scale") != args.scale:
+      print "Baseline was recorded with scale %s, comparing anyway" % baseline.get("scale")
+
+  print "%-28s %12s %12s" % ("Benchmark", "min", "median")
+  results, failures = runBenchmarks(names, args.scale, max(args.repeat, 1))
+
+  if args.save:
+    with open(args.save, "w") as fp:
+      json.dump(OrderedDict([
+        ("python", sys.version.split()[0]),
+        ("platform", platform.platform()),
+        ("scale", args.scale),
+        ("results", results)
+      ]), fp, indent=2)
+    print "Baseline saved to %s" % args.save
+
+  regressions = []
+  if baseline:
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+      print "Regressions: %s" % ", ".join(regressions)
+  if failures:
+    print "Failed: %s" % ", ".join(failures)
+  if regressions or failures:
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main()
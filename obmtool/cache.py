@@ -0,0 +1,235 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+def hashFiles(paths, extra=()):
+  digest = hashlib.sha1()
+  for value in extra:
+    digest.update(value + "\0")
+
+  for path in sorted(paths):
+    digest.update(os.path.basename(path) + "\0")
+    with open(path, "rb") as fp:
+      for chunk in iter(lambda: fp.read(65536), ""):
+        digest.update(chunk)
+  return digest.hexdigest()
+
+def hashPath(path):
+  """ Content hash of a file, or of a directory tree including file names. """
+  if not os.path.isdir(path):
+    return hashFiles([path])
+
+  digest = hashlib.sha1()
+  for root, dirs, files in os.walk(path):
+    dirs.sort()
+    for name in sorted(files):
+      filename = os.path.join(root, name)
+      digest.update(os.path.relpath(filename, path).replace(os.sep, "/") + "\0")
+      with open(filename, "rb") as fp:
+        for chunk in iter(lambda: fp.read(65536), ""):
+          digest.update(chunk)
+  return digest.hexdigest()
+
+def cloneTree(src, dst, linkDirs=(), ignore=()):
+  """ Cheaply copies the tree at src to dst, which must not exist yet.
+
+      Copy-on-write clones are used where the platform supports them.
+      Otherwise files below the directories in linkDirs (relative to src, "."
+      for all of them) are hardlinked and everything else is copied, so only files that are never
+      modified in place may be listed in linkDirs. Names in ignore are
+      skipped.
+  """
+  if not ignore:
+    if sys.platform.startswith("linux"):
+      clone = ["cp", "-a", "--reflink=always", src, dst]
+    elif sys.platform == "darwin":
+      clone = ["cp", "-cRp", src, dst]
+    else:
+      clone = None
+
+    if clone:
+      with open(os.devnull, "w") as devnull:
+        if subprocess.call(clone, stdout=devnull, stderr=devnull) == 0:
+          return
+      shutil.rmtree(dst, True)
+
+  linkDirs = [os.path.normpath(os.path.join(src, x)) + os.sep for x in linkDirs]
+  for root, dirs, files in os.walk(src):
+    dirs[:] = [x for x in dirs if x not in ignore]
+    target = os.path.join(dst, os.path.relpath(root, src))
+    if not os.path.isdir(target):
+      os.makedirs(target)
+
+    link = any((os.path.normpath(root) + os.sep).startswith(x) for x in linkDirs)
+    for name in files:
+      if name in ignore:
+        continue
+      if link:
+        try:
+          os.link(os.path.join(root, name), os.path.join(target, name))
+          continue
+        except (OSError, AttributeError):
+          pass
+      shutil.copy2(os.path.join(root, name), os.path.join(target, name))
+
+def breakLink(path):
+  """ Gives path its own copy of the data if it is hardlinked elsewhere,
+      so that it can be changed in place.
+  """
+  if not os.path.isfile(path) or os.stat(path).st_nlink < 2:
+    return
+  fd, tmppath = tempfile.mkstemp(prefix=".%s-" % os.path.basename(path),
+                                 dir=os.path.dirname(path))
+  os.close(fd)
+  try:
+    shutil.copy2(path, tmppath)
+    os.rename(tmppath, path)
+  except:
+    os.remove(tmppath)
+    raise
+
+class EntryLock(object):
+  """ A shared lock on a DirectoryCache entry, the entry is not evicted by
+      any process until the lock is closed. Without flock, e.g. on Windows,
+      entries are not locked.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.fd = None
+    if fcntl:
+      self.fd = os.open(path, os.O_RDONLY)
+      # Not inherited by helpers and Thunderbird, they outlive the lock
+      fcntl.fcntl(self.fd, fcntl.F_SETFD,
+                  fcntl.fcntl(self.fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+      fcntl.flock(self.fd, fcntl.LOCK_SH)
+
+  def valid(self):
+    """ False if the entry was evicted before the lock was taken. """
+    if self.fd is None:
+      return os.path.isdir(self.path)
+    try:
+      return os.stat(self.path).st_ino == os.fstat(self.fd).st_ino
+    except OSError:
+      return False
+
+  def close(self):
+    if self.fd is not None:
+      os.close(self.fd)
+      self.fd = None
+
+  __del__ = close
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, type, value, traceback):
+    self.close()
+
+class DirectoryCache(object):
+  """ A directory of content-addressed entries, evicted least recently used
+      first. Entries held with hold() are skipped.
+  """
+
+  def __init__(self, root, maxEntries=4):
+    self.root = root
+    self.maxEntries = maxEntries
+
+  def path(self, key):
+    return os.path.join(self.root, key)
+
+  def lookup(self, key):
+    path = self.path(key)
+    if not os.path.isdir(path):
+      return None
+
+    # The directory mtime doubles as the last used time for eviction
+    os.utime(path, None)
+    return path
+
+  def store(self, key, builder):
+    path = self.lookup(key)
+    if path:
+      return path
+
+    if not os.path.isdir(self.root):
+      os.makedirs(self.root)
+
+    # Build into a hidden directory and rename it into place, so that
+    # concurrent obmtool instances never see a half-built entry.
+    tmpdir = tempfile.mkdtemp(prefix=".%s-" % key, dir=self.root)
+    try:
+      builder(tmpdir)
+    except:
+      shutil.rmtree(tmpdir, True)
+      raise
+
+    path = self.path(key)
+    try:
+      os.rename(tmpdir, path)
+    except OSError:
+      # Someone else stored the same entry first, use theirs
+      shutil.rmtree(tmpdir, True)
+      if not os.path.isdir(path):
+        raise
+
+    self.evict(keep=key)
+    return path
+
+  def hold(self, key, builder=None):
+    """ Like store, or lookup without a builder, but returns an EntryLock
+        whose path is the entry. Use it while the entry is being read.
+    """
+    while True:
+      path = self.store(key, builder) if builder else self.lookup(key)
+      if not path:
+        return None
+      try:
+        lock = EntryLock(path)
+      except OSError:
+        # Evicted between the lookup and the lock
+        continue
+      if lock.valid():
+        return lock
+      lock.close()
+
+  def evict(self, keep=None):
+    entries = [x for x in os.listdir(self.root)
+               if not x.startswith(".") and x != keep and
+                  os.path.isdir(os.path.join(self.root, x))]
+    entries.sort(key=lambda x: os.stat(os.path.join(self.root, x)).st_mtime)
+
+    excess = len(entries) + (1 if keep else 0) - self.maxEntries
+    for entry in entries:
+      if excess <= 0:
+        break
+      path = os.path.join(self.root, entry)
+      try:
+        fd = os.open(path, os.O_RDONLY)
+      except OSError:
+        # Evicted by someone else
+        excess -= 1
+        continue
+      try:
+        if fcntl:
+          try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+          except IOError:
+            # Held by an obmtool that is still using it
+            continue
+        shutil.rmtree(path, True)
+        excess -= 1
+      finally:
+        os.close(fd)
@@ -1,24 +1,111 @@
 import socket
 import ssl
-from M2Crypto import X509
+import threading
 import base64
 import struct
 import binascii
 import logging
+import json
+import time
 import os
 
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from utils import atomicFile
+from tracing import tracer
+
+def fetchCertificate(host, port, ssl_version=None, timeout=None):
+  """ Returns the DER encoded certificate of the server at host:port. """
+  sock = socket.create_connection((host, port), timeout)
+  try:
+    sslsock = ssl.wrap_socket(sock, cert_reqs=ssl.CERT_NONE,
+                              ssl_version=ssl_version or ssl.PROTOCOL_SSLv23)
+    try:
+      return sslsock.getpeercert(True)
+    finally:
+      sslsock.close()
+  finally:
+    sock.close()
+
+class CertificateCache(object):
+  """ Persistent cache of server certificate fingerprints, keyed by host:port.
+
+      The cache is disabled until open() is called with a path.
+  """
+
+  def __init__(self):
+    self.path = None
+    self.ttl = 0
+    self.entries = {}
+    self.dirty = False
+    self.lock = threading.Lock()
+
+  def open(self, path, ttl=86400, refresh=False):
+    self.ttl = ttl
+    if path == self.path and not refresh:
+      # Already open, e.g. in obmtool serve
+      return
+
+    self.path = path
+    self.entries = {}
+    self.dirty = False
+    if not refresh and os.path.exists(path):
+      try:
+        with open(path) as fp:
+          self.entries = json.load(fp)
+      except ValueError:
+        logging.warning("Ignoring corrupt certificate cache %s" % path)
+
+  def get(self, host, port):
+    if not self.path:
+      return None
+    data = self.entries.get("%s:%s" % (host, port))
+    if data and time.time() - data["time"] < self.ttl:
+      return data
+    return None
+
+  def put(self, entry):
+    if not self.path:
+      return
+    with self.lock:
+      self.entries["%s:%s" % (entry.host, entry.port)] = {
+        "fingerprint": entry.fingerprint,
+        "issuerSerialHash": entry.issuerSerialHash,
+        "time": time.time()
+      }
+      self.dirty = True
+
+  def save(self):
+    if not self.path or not self.dirty:
+      return
+
+    dirname = os.path.dirname(os.path.abspath(self.path))
+    if not os.path.isdir(dirname):
+      os.makedirs(dirname)
+    with atomicFile(self.path) as fp:
+      json.dump(self.entries, fp, indent=2)
+    self.dirty = False
+
 class CertOverrideEntry:
   SHA256_OID = "OID.2.16.840.1.101.3.4.2.1"
 
   @staticmethod
-  def fromHost(host, port, certtype='U', ssl_version=None):
+  def fromHost(host, port, certtype='U', ssl_version=None, timeout=None):
+    cached = cache.get(host, port)
+    if cached:
+      logging.info("Using cached certificate for %s:%d" % (host, port))
+      return CertOverrideEntry(host, port, cached["fingerprint"], certtype,
+                               cached["issuerSerialHash"])
+
     logging.info("Getting certificate from %s:%d" % (host, port))
-    if ssl_version is None:
-      cert = ssl.get_server_certificate((host, port))
-    else:
-      cert = ssl.get_server_certificate((host, port), ssl_version=ssl_version)
-    x509 = X509.load_cert_string(cert.encode('ascii', 'ignore'))
-    return CertOverrideEntry(host, port, x509=x509, certtype=certtype)
+    with tracer.span("certificates.fetch", host="%s:%d" % (host, port)):
+      der = fetchCertificate(host, port, ssl_version, timeout)
+    # M2Crypto is only needed when the certificate is not cached
+    from M2Crypto import X509
+    x509 = X509.load_cert_der_string(der)
+    entry = CertOverrideEntry(host, port, x509=x509, certtype=certtype)
+    cache.put(entry)
+    return entry
 
   def __init__(self, host, port, fingerprint=None, certtype='U', issuerSerialHash=None, x509=None):
     self.host = host
@@ -53,15 +140,17 @@ class CertOverrideFile(object):
   HEADER = "# PSM Certificate Override Settings file\n# This is a generated file!  Do not edit."
 
   def __init__(self, path):
-    self.entries = set()
+    self.entries = OrderedDict()
     self.path = path
     self.read()
+    self.dirty = False
 
   def write(self):
-    fp = open(self.path, "w")
-    fp.write(CertOverrideFile.HEADER + "\n")
-    fp.write("\n".join(map(str, self.entries)))
-    fp.close()
+    if not self.dirty:
+      return
+    with atomicFile(self.path) as fp:
+      fp.write(str(self))
+    self.dirty = False
 
   def read(self, fp=None):
     if fp is None:
@@ -81,10 +170,48 @@ class CertOverrideFile(object):
       self.add(entry)
 
   def add(self, entry):
-    self.entries.add(entry)
+    key = "%s:%s" % (entry.host, entry.port)
+    existing = self.entries.get(key)
+    if existing is None or str(existing) != str(entry):
+      self.entries[key] = entry
+      self.dirty = True
 
   def addEntry(self, host, port):
-    self.entries.add(CertOverrideEntry.fromHost(host, port))
+    self.add(CertOverrideEntry.fromHost(host, port))
+
+  def addEntries(self, hosts, timeout=None, jobs=8):
+    """ Fetches the certificates for a list of (host, port) tuples
+        concurrently. Returns a list of (host, port, exception) tuples for
+        the hosts that failed, the other entries are added.
+    """
+    def fetch(hostport):
+      host, port = hostport
+      try:
+        return CertOverrideEntry.fromHost(host, port, timeout=timeout), None
+      except Exception, e:
+        return None, (host, port, e)
+
+    if not len(hosts):
+      return []
+
+    with tracer.span("certificates.addEntries", count=len(hosts)):
+      pool = ThreadPool(min(jobs, len(hosts)))
+      try:
+        results = pool.map(fetch, hosts)
+      finally:
+        pool.close()
+        pool.join()
+
+    failures = []
+    for entry, failure in results:
+      if entry:
+        self.add(entry)
+      else:
+        failures.append(failure)
+    return failures
 
   def __str__(self):
-    return CertOverrideFile.HEADER + "\n" + "\n".join(map(str, self.entries))
+    return CertOverrideFile.HEADER + "\n" + "\n".join(map(str, self.entries.values()))
+
+# our global instance
+cache = CertificateCache()
@@ -13,16 +13,21 @@ class ObmToolConfig(object):
     self.userConfig = {}
     self.dirty = False
     self.userFilePath = None
+    self.defaultRead = False
+    self.snapshot = None
 
   def readDefaultFile(self):
     fullpath = os.path.join(os.path.dirname(__file__), "..", "obmtoolrc")
     if os.path.exists(fullpath):
       self.defaultConfig = INIConfig(open(fullpath))
+    self.defaultRead = True
+    self.snapshot = None
 
   def readUserFile(self, userFilePath=None):
     self.userFilePath = userFilePath
     self.dirty = False
     self.userConfig = INIConfig(open(self.userFilePath))
+    self.snapshot = None
 
   def saveUserFile(self):
     if self.dirty:
@@ -30,18 +35,41 @@ class ObmToolConfig(object):
       print >>f, self.userConfig
       f.close()
 
+  def getSnapshot(self):
+    """ Returns the merged user and default config, which is compiled on
+        first use and kept until the config changes. Values are typed for
+        get(), getAll() keeps the raw values of the section that wins.
+        Keys are case insensitive like in iniparse, which lists them in
+        lower case, so they are stored in lower case for get().
+    """
+    if self.snapshot is None:
+      # The default file is only read when the config is first used
+      if not self.defaultRead:
+        self.readDefaultFile()
+
+      values = {}
+      sections = {}
+      for cfg in (self.defaultConfig, self.userConfig):
+        for section in cfg:
+          pairs = tuple((x, cfg[section][x]) for x in cfg[section])
+          sections[section] = pairs
+          typed = values.setdefault(section, {})
+          for key, value in pairs:
+            typed[key.lower()] = ObmToolConfig.correctType(value.decode("string_escape"))
+      self.snapshot = ConfigSnapshot(values, sections)
+    return self.snapshot
+
   def getAll(self, section, defaultValue=None, exception=False):
-    if section in self.userConfig:
-      return [[x,self.userConfig[section][x]] for x in self.userConfig[section]]
-    elif section in self.defaultConfig:
-      return [[x,self.defaultConfig[section][x]] for x in self.defaultConfig[section]]
+    pairs = self.getSnapshot().sections.get(section)
+    if pairs is not None:
+      return [[key, value] for key, value in pairs]
     elif exception:
       raise ConfigMissingException(section, None)
     else:
       return defaultValue
 
   @staticmethod
-  def correctType(val):
+  def correctType(val, floats=True):
     lval = val.lower() if isinstance(val, basestring) else val
     if lval in ("true", "false"):
       return lval == "true"
@@ -51,30 +79,27 @@ class ObmToolConfig(object):
     except (ValueError, TypeError):
       pass
 
-    try:
-      return float(val)
-    except (ValueError, TypeError):
-      pass
+    if floats:
+      try:
+        return float(val)
+      except (ValueError, TypeError):
+        pass
 
     return val
 
   def get(self, section, key, defaultValue=None, exception=False):
-    val = None
-    if section in self.userConfig and key in self.userConfig[section]:
-      val = self.userConfig[section][key].decode("string_escape")
-    elif section in self.defaultConfig and key in self.defaultConfig[section]:
-      val = self.defaultConfig[section][key].decode("string_escape")
+    values = self.getSnapshot().values
+    if section in values and key.lower() in values[section]:
+      return values[section][key.lower()]
+    elif exception:
+      raise ConfigMissingException(section, key)
     else:
-      if exception:
-        raise ConfigMissingException(section, key)
-      else:
-        val = defaultValue
-
-    return ObmToolConfig.correctType(val)
+      return ObmToolConfig.correctType(defaultValue)
 
   def set(self, section, key, value):
     self.dirty = True
     self.userConfig[section][key] = value.encode("string_escape")
+    self.snapshot = None
 
   def require(self, section, key):
     return self.get(section, key, exception=True)
@@ -82,6 +107,13 @@ class ObmToolConfig(object):
   def format(self, section, key, data):
     return self.get(section, key, "").decode('utf-8').format(**data)
 
+class ConfigSnapshot(object):
+  """ The compiled config, see ObmToolConfig.getSnapshot. """
+  __slots__ = ("values", "sections")
+
+  def __init__(self, values, sections):
+    self.values = values
+    self.sections = sections
+
 # our global instance
 config = ObmToolConfig()
-config.readDefaultFile()
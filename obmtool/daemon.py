@@ -0,0 +1,351 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import OrderedDict
+import SocketServer
+import argparse
+import copy
+import hashlib
+import json
+import logging
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+
+from config import config
+from prefs import PrefsFile
+from profile import ObmProfile
+
+# Directory inside the profile cache where prepared profiles are kept, it
+# must be on the same file system so that they can be renamed into place.
+POOL_DIRECTORY = ".pool"
+
+# Seconds to wait for obmtool serve before building the profile locally,
+# can be changed with daemonTimeout in the [defaults] section
+REQUEST_TIMEOUT = 60
+
+def sendCommand(socketPath, request, timeout=REQUEST_TIMEOUT):
+  """ Sends a request to obmtool serve and returns its reply. """
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.settimeout(timeout)
+    sock.connect(socketPath)
+    sock.sendall(json.dumps(request) + "\n")
+    return json.loads(sock.makefile("rb").readline())
+  finally:
+    sock.close()
+
+def requestProfile(socketPath, argv):
+  """ Asks a running obmtool serve to set up the profile for the obmtool
+      command line argv. Returns True when the profile is ready to be opened
+      as a prepared profile, False if it needs to be built locally.
+  """
+  if not hasattr(socket, "AF_UNIX") or not os.path.exists(socketPath):
+    return False
+
+  try:
+    reply = sendCommand(socketPath, { "command": "profile",
+                                      "argv": argv,
+                                      "cwd": os.getcwd() },
+                        config.get("defaults", "daemonTimeout", REQUEST_TIMEOUT))
+  except (socket.error, ValueError), e:
+    logging.info("Could not reach obmtool serve at %s: %s" % (socketPath, e))
+    return False
+
+  if "error" in reply:
+    print "obmtool serve could not prepare the profile: %s" % reply["error"]
+    return False
+
+  logging.info("Using profile prepared by obmtool serve in %s" % reply["profile"])
+  return True
+
+class ObmDaemon(object):
+  """ Keeps profiles ready for the obmtool command lines it has been asked
+      for, so that the next obmtool with the same configuration only needs
+      to rename a profile into place.
+
+      Config, version metadata, certificates and the NSS libraries stay
+      loaded between requests. Profiles are built one at a time under
+      buildLock, since the config and in-process NSS are process wide. The
+      pool has its own lock, so that a ready profile is handed out while
+      the next one is being built.
+  """
+
+  # Number of different configurations to keep profiles ready for
+  MAX_CONFIGURATIONS = 4
+
+  def __init__(self, poolSize=2):
+    self.poolSize = poolSize
+    self.lock = threading.Lock()
+    self.buildLock = threading.Lock()
+    self.wakeup = threading.Condition(self.lock)
+    self.running = True
+
+    # key -> paths of ready profiles, and key -> (argv, cwd) to build them
+    self.ready = {}
+    self.recipes = OrderedDict()
+
+  def setup(self, argv, cwd):
+    from obmtool.app import createParser, setupArgs
+
+    previous = os.getcwd()
+    os.chdir(cwd)
+    try:
+      args = createParser().parse_args(argv)
+      setupArgs(args)
+    finally:
+      os.chdir(previous)
+    return args
+
+  @staticmethod
+  def poolKey(args):
+    digest = hashlib.sha1()
+    for value in [ObmProfile.templateKey(args.user, args.password, args.server,
+                                         args.tbversion, args.thunderbird,
+                                         args.extension, args.preferences),
+                  config.get("profile", "certificates", ""),
+                  config.get("profile", "signons", ""),
+                  args.cachePath, args.nssCache, args.templateCache,
+                  args.addonCache]:
+      digest.update(repr(value) + "\0")
+    return digest.hexdigest()
+
+  def build(self, args, cachePath=None):
+    from obmtool.app import profileArgs, setupProfile
+    import obmtool.certificates
+    import obmtool.utils
+
+    buildArgs = copy.copy(args)
+    buildArgs.reset = False
+    if cachePath:
+      buildArgs.cachePath = cachePath
+
+    # mozprofile must not undo the add-ons and preferences once the profile
+    # object goes away, the profile is used by the client.
+    profile = ObmProfile(restore=False, **profileArgs(buildArgs))
+    setupProfile(profile)
+    obmtool.certificates.cache.save()
+    obmtool.utils.metadata.save()
+    return profile.profile
+
+  def prepare(self, key, args):
+    """ Builds a profile for the pool and returns its path. """
+    poolRoot = os.path.abspath(os.path.join(args.cachePath, POOL_DIRECTORY))
+    if not os.path.isdir(poolRoot):
+      os.makedirs(poolRoot)
+    cachePath = tempfile.mkdtemp(prefix="%s-" % key[:12], dir=poolRoot)
+    try:
+      path = self.build(args, cachePath)
+    except:
+      shutil.rmtree(cachePath, True)
+      raise
+    return path
+
+  def take(self, key, target):
+    paths = self.ready.get(key)
+    if not paths:
+      return False
+
+    path = paths.pop(0)
+    if not os.path.isdir(os.path.dirname(target)):
+      os.makedirs(os.path.dirname(target))
+    os.rename(path, target)
+    shutil.rmtree(os.path.dirname(path), True)
+
+    # The IMAP directory is the only absolute path in prefs.js
+    prefs = PrefsFile(os.path.join(target, "prefs.js"))
+    directory = prefs.get("mail.server.server1.directory")
+    if directory:
+      prefs.set("mail.server.server1.directory",
+                os.path.join(os.path.abspath(target), os.path.relpath(directory, path)))
+    prefs.write()
+    return True
+
+  def remember(self, key, argv, cwd):
+    self.recipes.pop(key, None)
+    self.recipes[key] = (argv, cwd)
+    while len(self.recipes) > ObmDaemon.MAX_CONFIGURATIONS:
+      oldest = self.recipes.popitem(last=False)[0]
+      self.discard(oldest)
+    self.wakeup.notify()
+
+  def discard(self, key):
+    for path in self.ready.pop(key, []):
+      shutil.rmtree(os.path.dirname(path), True)
+
+  def provide(self, argv, cwd):
+    with self.lock:
+      args = self.setup(argv, cwd)
+      key = ObmDaemon.poolKey(args)
+      target = os.path.join(args.cachePath,
+                            ObmProfile.profileNameFor(args.user, args.tbversion))
+
+      if args.reset and os.path.exists(target):
+        print "Reseting profile in",target
+        shutil.rmtree(target)
+
+      taken = not os.path.exists(target) and self.take(key, target)
+
+    if not taken:
+      # Existing profiles are brought up to date in place, which is quick
+      # with everything loaded already.
+      with self.buildLock:
+        self.build(args)
+
+    with self.lock:
+      self.remember(key, argv, cwd)
+    return target
+
+  def fill(self):
+    """ Builds profiles in the background until every configuration has
+        poolSize of them.
+    """
+    while True:
+      with self.lock:
+        while self.running and not self.missing():
+          self.wakeup.wait()
+        if not self.running:
+          return
+
+        key = self.missing()[0]
+        argv, cwd = self.recipes[key]
+        try:
+          args = self.setup(argv, cwd)
+        except (Exception, SystemExit), e:
+          args = None
+          error = e
+
+      # Clients are served from the pool while the profile is built
+      if args:
+        try:
+          with self.buildLock:
+            path = self.prepare(key, args)
+        except (Exception, SystemExit), e:
+          args = None
+          error = e
+
+      with self.lock:
+        if not args:
+          logging.warning("Could not prepare a profile for %s: %s" % (" ".join(argv), error))
+          self.recipes.pop(key, None)
+        elif self.running and key in self.recipes:
+          self.ready.setdefault(key, []).append(path)
+          logging.info("Prepared profile %s" % path)
+        else:
+          # The configuration was dropped while the profile was built
+          shutil.rmtree(os.path.dirname(path), True)
+
+  def missing(self):
+    return [key for key in self.recipes
+            if len(self.ready.get(key, [])) < self.poolSize]
+
+  def handle(self, request):
+    command = request.get("command")
+    if command == "profile":
+      return { "profile": self.provide(request["argv"], request["cwd"]) }
+    elif command == "status":
+      with self.lock:
+        return { "pid": os.getpid(),
+                 "ready": dict((" ".join(self.recipes[key][0]) or "(defaults)",
+                                len(self.ready.get(key, [])))
+                               for key in self.recipes) }
+    elif command == "stop":
+      self.stop()
+      return { "stopped": True }
+    else:
+      return { "error": "Unknown command %s" % command }
+
+  def stop(self):
+    with self.lock:
+      self.running = False
+      self.wakeup.notify_all()
+
+  def cleanup(self):
+    with self.lock:
+      for key in self.ready.keys():
+        self.discard(key)
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+  def handle(self):
+    try:
+      reply = self.server.obmDaemon.handle(json.loads(self.rfile.readline()))
+    except SystemExit:
+      reply = { "error": "Invalid obmtool arguments" }
+    except Exception, e:
+      logging.exception("Request failed")
+      reply = { "error": str(e) }
+    self.wfile.write(json.dumps(reply) + "\n")
+
+def serve(argv):
+  parser = argparse.ArgumentParser(prog="obmtool serve", description="Keep profiles ready for obmtool in the background. The obmtool arguments given after the options select the configuration to prepare profiles for right away, more are added as clients ask for them.")
+  parser.add_argument('--pool', type=int, default=None, help="Number of profiles to keep ready for each configuration (default: defaults.poolSize or 1)")
+  parser.add_argument('--status', action='store_true', help="Show what a running obmtool serve has ready and exit")
+  parser.add_argument('--stop', action='store_true', help="Stop a running obmtool serve")
+  parser.add_argument('args', nargs=argparse.REMAINDER, help="obmtool arguments, after --")
+  options = parser.parse_args(argv)
+  if options.args[:1] == ["--"]:
+    options.args = options.args[1:]
+
+  if not hasattr(socket, "AF_UNIX"):
+    print "obmtool serve needs Unix domain sockets, which this platform doesn't have"
+    sys.exit(1)
+
+  daemon = ObmDaemon()
+  args = daemon.setup(options.args, os.getcwd())
+  socketPath = args.socket
+
+  if options.status or options.stop:
+    try:
+      reply = sendCommand(socketPath, { "command": "stop" if options.stop else "status" }, 10)
+    except socket.error, e:
+      print "obmtool serve is not running on %s: %s" % (socketPath, e)
+      sys.exit(1)
+    print json.dumps(reply, indent=2)
+    return
+
+  if os.path.exists(socketPath):
+    try:
+      sendCommand(socketPath, { "command": "status" }, 10)
+      print "obmtool serve is already running on %s" % socketPath
+      sys.exit(1)
+    except socket.error:
+      # Left behind by a daemon that didn't exit cleanly
+      os.remove(socketPath)
+
+  daemon.poolSize = options.pool or config.get("defaults", "poolSize", 1)
+  shutil.rmtree(os.path.join(args.cachePath, POOL_DIRECTORY), True)
+  with daemon.lock:
+    daemon.remember(ObmDaemon.poolKey(args), options.args, os.getcwd())
+
+  # The profiles contain passwords, only this user may connect
+  if not os.path.isdir(os.path.dirname(socketPath)):
+    os.makedirs(os.path.dirname(socketPath))
+  umask = os.umask(0077)
+  try:
+    server = SocketServer.UnixStreamServer(socketPath, RequestHandler)
+  finally:
+    os.umask(umask)
+  server.obmDaemon = daemon
+  server.timeout = 1
+
+  builder = threading.Thread(target=daemon.fill)
+  builder.daemon = True
+  builder.start()
+
+  print "obmtool serve listening on %s" % socketPath
+  try:
+    while daemon.running:
+      server.handle_request()
+  except KeyboardInterrupt:
+    print "\nStopping..."
+  finally:
+    daemon.stop()
+    server.server_close()
+    if os.path.exists(socketPath):
+      os.remove(socketPath)
+    builder.join(60)
+    daemon.cleanup()
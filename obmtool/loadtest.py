@@ -0,0 +1,307 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import OrderedDict
+import SocketServer
+import argparse
+import copy
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+from config import config
+from logfollower import LogFollower
+from logparser import ConnectorLogParser, statistics
+from utils import atomicFile
+import provision
+
+def parseRamp(value):
+  """ Parses a ramp like "2@0,5@60,10@120" into sorted (seconds, count)
+      steps: up to 2 instances from the start, 5 after a minute and 10 after
+      two minutes.
+  """
+  steps = []
+  for step in filter(bool, value.split(",")):
+    count, sep, seconds = step.strip().partition("@")
+    steps.append((float(seconds or 0), int(count)))
+  return sorted(steps)
+
+def allowedInstances(ramp, elapsed, default):
+  """ The number of instances that may run elapsed seconds into the test,
+      never more than the default, which is the number of instances.
+  """
+  allowed = 0 if ramp else default
+  for seconds, count in ramp:
+    if seconds <= elapsed:
+      allowed = min(count, default)
+  return allowed
+
+class StandInHandler(BaseHTTPRequestHandler):
+  def handle_one_request(self):
+    self.start = time.time()
+    BaseHTTPRequestHandler.handle_one_request(self)
+
+  def reply(self):
+    length = int(self.headers.get("Content-Length") or 0)
+    if length:
+      self.rfile.read(length)
+
+    standIn = self.server.standIn
+    if standIn.delay:
+      time.sleep(standIn.delay)
+
+    self.send_response(standIn.status)
+    self.send_header("Content-Type", standIn.contentType)
+    self.send_header("Content-Length", str(len(standIn.body)))
+    self.end_headers()
+    if self.command != "HEAD":
+      self.wfile.write(standIn.body)
+    standIn.record(self.command, self.path, time.time() - self.start)
+
+  do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = reply
+
+  def log_message(self, format, *args):
+    logging.debug("Stand-in server: " + format % args)
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+class StandInServer(object):
+  """ A local HTTP server to point the connectors at instead of an OBM
+      server. Every request gets the same reply after delay seconds, the
+      number of requests and the time taken to answer them are counted.
+  """
+
+  def __init__(self, port=0, delay=0, body="", status=200,
+               contentType="text/xml; charset=utf-8"):
+    self.delay = delay
+    self.body = body
+    self.status = status
+    self.contentType = contentType
+    self.lock = threading.Lock()
+    self.requests = OrderedDict()
+    self.durations = []
+
+    self.server = ThreadingHTTPServer(("127.0.0.1", port), StandInHandler)
+    self.server.standIn = self
+    self.thread = None
+
+  @property
+  def uri(self):
+    return "http://127.0.0.1:%d/obm-sync" % self.server.server_address[1]
+
+  def record(self, method, path, duration):
+    key = "%s %s" % (method, path.split("?")[0])
+    with self.lock:
+      self.requests[key] = self.requests.get(key, 0) + 1
+      self.durations.append(duration)
+
+  def summary(self):
+    with self.lock:
+      return OrderedDict([
+        ("requests", statistics(self.durations)),
+        ("paths", OrderedDict(self.requests))
+      ])
+
+  def start(self):
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+    self.thread.join()
+
+class LoadInstance(object):
+  """ One Thunderbird of the load test and the syncs in its connector log. """
+
+  def __init__(self, index, userName, runner):
+    self.index = index
+    self.userName = userName
+    self.runner = runner
+    self.parser = ConnectorLogParser.fromConfig(config)
+    self.follower = None
+    self.started = None
+    self.stopped = None
+
+  def start(self):
+    connectorLog = self.runner.profile.connectorLog
+    if not os.path.exists(connectorLog):
+      open(connectorLog, "a").close()
+    self.follower = LogFollower(connectorLog)
+    self.follower.seekEnd()
+    self.runner.start()
+    self.started = time.time()
+
+  def poll(self, verbose=False):
+    lines = self.follower.read()
+    self.parser.feedLines(lines)
+    if verbose:
+      for line in lines:
+        print "Connector %d:" % self.index, line.rstrip()
+
+  def stop(self):
+    if self.runner.is_running():
+      self.runner.stop()
+    self.poll()
+    self.follower.close()
+    self.stopped = time.time()
+
+  def summary(self):
+    return OrderedDict([
+      ("instance", self.index),
+      ("user", self.userName),
+      ("profile", self.runner.profile.profile),
+      ("started", self.started),
+      ("stopped", self.stopped),
+      ("sync", self.parser.summary())
+    ])
+
+def assignUsers(args, users, count):
+  """ Spreads count instances over the users, round robin. Each instance
+      gets its own profile, also when several use the same account.
+  """
+  if not users:
+    users = [(args.user, None, None)]
+  return [users[i % len(users)] + (i + 1,) for i in range(count)]
+
+def runSchedule(instances, options, verbose=False):
+  """ Starts the instances at least stagger seconds apart and as far as the
+      ramp allows, stopping each one after duration seconds.
+  """
+  pending = list(instances)
+  running = []
+  start = time.time()
+  lastStart = None
+
+  try:
+    while pending or running:
+      now = time.time()
+      for instance in list(running):
+        instance.poll(verbose)
+        if not instance.runner.is_running() or \
+           (options.duration and now - instance.started >= options.duration):
+          instance.stop()
+          running.remove(instance)
+          print "Stopped instance %d (%s) after %.1fs" % (
+                instance.index, instance.userName, instance.stopped - instance.started)
+
+      allowed = allowedInstances(options.ramp, now - start, len(instances))
+      if pending and len(running) < allowed and \
+         (lastStart is None or now - lastStart >= options.stagger):
+        instance = pending.pop(0)
+        print "Starting instance %d (%s), %d running" % (
+              instance.index, instance.userName, len(running) + 1)
+        instance.start()
+        running.append(instance)
+        lastStart = instance.started
+
+      time.sleep(0.25)
+  except KeyboardInterrupt:
+    print "\nStopping %d instances..." % len(running)
+    for instance in running:
+      instance.stop()
+
+  return time.time() - start
+
+def exportLoad(path, options, instances, merged, standIn, elapsed):
+  data = OrderedDict([
+    ("instances", len(instances)),
+    ("stagger", options.stagger),
+    ("ramp", options.ramp),
+    ("duration", options.duration),
+    ("elapsed", elapsed),
+    ("summary", merged.summary()),
+    ("perInstance", [instance.summary() for instance in instances if instance.started]),
+    ("standIn", standIn.summary() if standIn else None)
+  ])
+  with atomicFile(path) as fp:
+    json.dump(data, fp, indent=2)
+
+def loadStatsPath(args):
+  statsDir = config.get("paths", "syncStats", None)
+  if statsDir is None:
+    statsDir = os.path.join(args.cachePath, "syncstats")
+  if not statsDir:
+    return None
+  statsDir = os.path.expanduser(statsDir)
+  if not os.path.isdir(statsDir):
+    os.makedirs(statsDir)
+  return os.path.join(statsDir, "load-%s.json" % time.strftime("%Y%m%d-%H%M%S"))
+
+def load(argv):
+  from obmtool.app import createParser, createRunner, setupArgs
+
+  parser = argparse.ArgumentParser(prog="obmtool load", description="Run many Thunderbird instances against an OBM server at once and summarize their sync times. The obmtool arguments given after the options are used for all instances.")
+  parser.add_argument('-n', '--instances', type=int, required=True, help="Number of Thunderbird instances to run")
+  parser.add_argument('--users', metavar='FILE', default=None, help="CSV file with the users to spread the instances over, as for obmtool provision (default: the obmtool user for all)")
+  parser.add_argument('--stagger', type=float, default=5, metavar='SECONDS', help="Minimum time between two instances starting (default: 5)")
+  parser.add_argument('--ramp', type=parseRamp, default=[], metavar='COUNT@SECONDS,...', help="How many instances may run at which time, e.g. 2@0,5@60,10@120 (default: all of them)")
+  parser.add_argument('--duration', type=float, default=300, metavar='SECONDS', help="How long each instance runs, 0 to wait for Thunderbird to exit (default: 300)")
+  parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(), help="Number of profiles to build in parallel (default: number of CPUs)")
+  parser.add_argument('--stand-in', dest='standIn', type=int, default=None, metavar='PORT', help="Point all instances at a local stand-in HTTP server on PORT, 0 for any free port")
+  parser.add_argument('--stand-in-delay', dest='standInDelay', type=float, default=0, metavar='SECONDS', help="Time the stand-in server takes to answer each request")
+  parser.add_argument('--output', default=None, metavar='FILE', help="Write the results as JSON to FILE (default: a load- file in paths.syncStats)")
+  parser.add_argument('args', nargs=argparse.REMAINDER, help="obmtool arguments, after --")
+  options = parser.parse_args(argv)
+  if options.args[:1] == ["--"]:
+    options.args = options.args[1:]
+
+  args = createParser().parse_args(options.args)
+  setupArgs(args)
+  args.templateCache = None
+
+  standIn = None
+  if options.standIn is not None:
+    standIn = StandInServer(options.standIn, options.standInDelay)
+    standIn.start()
+    args.server = standIn.uri
+    args.standIn = True
+    print "Stand-in server listening on %s" % args.server
+
+  try:
+    users = provision.readUsers(options.users) if options.users else []
+    if standIn:
+      users = [(user, password, None) for user, password, server in users]
+    assigned = assignUsers(args, users, options.instances)
+
+    print "Setting up %d profiles..." % len(assigned)
+    built, failures = provision.provisionProfiles(args, assigned, options.jobs)
+    if failures:
+      print "Could not set up the profiles of %s" % ", ".join(sorted(set(x[0] for x in failures)))
+      sys.exit(1)
+
+    instances = []
+    for userName, password, server, index in assigned:
+      instanceArgs = copy.copy(args)
+      instanceArgs.user = userName
+      instanceArgs.password = password or args.password
+      instanceArgs.server = server or args.server
+      instanceArgs.instance = index
+      instanceArgs.prepared = True
+      instances.append(LoadInstance(index, userName, createRunner(instanceArgs)))
+
+    elapsed = runSchedule(instances, options, args.verbose)
+  finally:
+    if standIn:
+      standIn.stop()
+
+  merged = ConnectorLogParser.merge([instance.parser for instance in instances])
+  print "Ran %d instances in %.0fs" % (len([x for x in instances if x.started]), elapsed)
+  print merged.formatSummary()
+  if standIn:
+    summary = standIn.summary()
+    print "Stand-in server answered %d requests (%.1f/sec)" % (
+          summary["requests"]["count"], summary["requests"]["count"] / elapsed if elapsed else 0)
+
+  path = options.output or loadStatsPath(args)
+  if path:
+    exportLoad(path, options, instances, merged, standIn, elapsed)
+    print "Load test results written to %s" % path
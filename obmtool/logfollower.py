@@ -0,0 +1,210 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_CLOEXEC = 0x00080000
+IN_NONBLOCK = 0x00000800
+
+INOTIFY_EVENT = struct.Struct("iIII")
+
+class Inotify(object):
+  """ Watches a directory for changes to a single file name using inotify.
+
+      The directory is watched instead of the file itself, so that the watch
+      survives the file being rotated or recreated.
+  """
+
+  MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+          IN_CREATE | IN_DELETE)
+
+  def __init__(self, path):
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    dirname = os.path.dirname(os.path.abspath(path))
+    if libc.inotify_add_watch(self.fd, dirname, Inotify.MASK) < 0:
+      err = ctypes.get_errno()
+      os.close(self.fd)
+      raise OSError(err, "inotify_add_watch failed for %s" % dirname)
+
+    self.name = os.path.basename(path)
+
+  def wait(self, timeout):
+    """ Returns True if the file changed before the timeout ran out. """
+    deadline = time.time() + timeout
+    while True:
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        return False
+      try:
+        readable = select.select([self.fd], [], [], remaining)[0]
+      except select.error, e:
+        if e.args[0] == errno.EINTR:
+          continue
+        raise
+      if readable and self._matches():
+        return True
+
+  def _matches(self):
+    try:
+      data = os.read(self.fd, 65536)
+    except OSError, e:
+      if e.errno == errno.EAGAIN:
+        return False
+      raise
+
+    offset = 0
+    matched = False
+    while offset + INOTIFY_EVENT.size <= len(data):
+      wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+      offset += INOTIFY_EVENT.size
+      name = data[offset:offset + length].rstrip("\0")
+      offset += length
+      matched = matched or name == self.name
+    return matched
+
+  def close(self):
+    os.close(self.fd)
+
+class LogFollower(object):
+  """ Follows a log file that is being appended to, like tail -F.
+
+      New lines are returned in batches as soon as they are written. A
+      truncated file is read again from the start, and when the file is
+      rotated the rest of the old file is read before switching over.
+      Without inotify the file is polled every pollInterval seconds.
+  """
+
+  def __init__(self, path, pollInterval=0.25):
+    self.path = path
+    self.pollInterval = pollInterval
+    self.fd = None
+    self.position = 0
+    self.partial = ""
+
+    self.watch = None
+    if sys.platform.startswith("linux"):
+      try:
+        self.watch = Inotify(path)
+      except (OSError, AttributeError):
+        pass
+
+    self._open()
+
+  def _open(self):
+    try:
+      self.fd = os.open(self.path, os.O_RDONLY)
+    except OSError, e:
+      if e.errno != errno.ENOENT:
+        raise
+      self.fd = None
+    self.position = 0
+
+  def _drain(self):
+    chunks = []
+    while True:
+      data = os.read(self.fd, 65536)
+      if not data:
+        break
+      chunks.append(data)
+      self.position += len(data)
+    return "".join(chunks)
+
+  def seekEnd(self):
+    """ Skips everything written so far. """
+    self.partial = ""
+    if self.fd is None:
+      self._open()
+    if self.fd is not None:
+      self.position = os.lseek(self.fd, 0, os.SEEK_END)
+
+  def read(self):
+    """ Returns the complete lines written since the last call, without
+        blocking. An incomplete last line is kept until it is finished.
+    """
+    if self.fd is None:
+      self._open()
+      if self.fd is None:
+        return []
+
+    data = ""
+    try:
+      pathStat = os.stat(self.path)
+    except OSError:
+      pathStat = None
+
+    fdStat = os.fstat(self.fd)
+    if pathStat and (pathStat.st_ino, pathStat.st_dev) != (fdStat.st_ino, fdStat.st_dev):
+      # The file was rotated, finish the old one and start on the new one
+      data = self._drain()
+      os.close(self.fd)
+      self._open()
+      if self.partial or data:
+        data += "\n" if not data.endswith("\n") else ""
+    elif fdStat.st_size < self.position:
+      # The file was truncated
+      self.partial = ""
+      os.lseek(self.fd, 0, os.SEEK_SET)
+      self.position = 0
+
+    if self.fd is not None:
+      data += self._drain()
+
+    lines = (self.partial + data).split("\n")
+    self.partial = lines.pop()
+    return lines
+
+  def wait(self, timeout):
+    """ Blocks until the file might have changed, or the timeout ran out. """
+    if self.watch:
+      return self.watch.wait(timeout)
+    time.sleep(min(timeout, self.pollInterval))
+    return True
+
+  def follow(self, isRunning, timeout=0.5):
+    """ Yields batches of lines as long as isRunning() returns True, then
+        the lines written until then, including an unterminated last line.
+    """
+    while isRunning():
+      lines = self.read()
+      if lines:
+        yield lines
+      self.wait(timeout)
+
+    lines = self.read()
+    if self.partial:
+      lines.append(self.partial)
+      self.partial = ""
+    if lines:
+      yield lines
+
+  def close(self):
+    if self.fd is not None:
+      os.close(self.fd)
+      self.fd = None
+    if self.watch:
+      self.watch.close()
+      self.watch = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, type, value, traceback):
+    self.close()
@@ -0,0 +1,192 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import OrderedDict
+import json
+import math
+import re
+import time
+
+from utils import atomicFile
+
+# The patterns can be overridden in the [logparser] section of the config.
+# Named groups are used for the timestamp and the collection name.
+PATTERNS = OrderedDict([
+  ("timestamp", r"^\[?(?P<timestamp>\d{4}-\d\d-\d\d[ T]\d\d:\d\d:\d\d(?:[.,]\d+)?)"),
+  ("syncStart", r"(?i)\bsynchroni[sz]ation (?:started|starting|begins?)\b"),
+  ("syncEnd", r"(?i)\bsynchroni[sz]ation (?:finished|ended|done|complete[ds]?)\b"),
+  ("collectionStart", r"(?i)\b(?:start(?:ing)?|begin(?:ning)?) sync(?:hroni[sz]ation)? (?:of|for) (?P<collection>[^:]+?)\s*(?:$|:)"),
+  ("collectionEnd", r"(?i)\b(?:finished|ended|done with) sync(?:hroni[sz]ation)? (?:of|for) (?P<collection>[^:]+?)\s*(?:$|:)"),
+  ("request", r"(?i)\b(?:sending|send) request\b|\b(?:GET|POST|PUT|DELETE) https?://"),
+  ("error", r"(?i)\b(?:error|exception)\b")
+])
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def percentile(values, p):
+  """ The p-th percentile of values using the nearest rank method. """
+  if not values:
+    return None
+  values = sorted(values)
+  rank = max(int(math.ceil(p / 100.0 * len(values))) - 1, 0)
+  return values[min(rank, len(values) - 1)]
+
+def statistics(values):
+  return OrderedDict([
+    ("count", len(values)),
+    ("p50", percentile(values, 50)),
+    ("p95", percentile(values, 95)),
+    ("max", max(values) if values else None)
+  ])
+
+class ConnectorLogParser(object):
+  """ Collects sync timings from the lines of obm-connector-log.txt.
+
+      Lines are attributed to the sync that is running when they are fed.
+      If the log has no timestamps, the time the line was fed is used, which
+      is accurate enough when following the log while Thunderbird runs.
+  """
+
+  def __init__(self, patterns=None, timestampFormat=TIMESTAMP_FORMAT):
+    self.patterns = OrderedDict()
+    for name, pattern in PATTERNS.iteritems():
+      if patterns and patterns.get(name):
+        pattern = patterns[name]
+      self.patterns[name] = re.compile(pattern)
+    self.timestampFormat = timestampFormat
+
+    self.syncs = []
+    self.collections = OrderedDict()
+    self.requests = 0
+    self.errors = []
+    self.current = None
+    self.collectionStarts = {}
+
+  @staticmethod
+  def fromConfig(config):
+    # iniparse lists the keys in lower case
+    values = dict((key.lower(), value) for key, value in config.getAll("logparser", []))
+    timestampFormat = values.pop("timestampformat", TIMESTAMP_FORMAT)
+    patterns = dict((name, values[name.lower()]) for name in PATTERNS
+                    if name.lower() in values)
+    return ConnectorLogParser(patterns, timestampFormat)
+
+  @staticmethod
+  def merge(parsers):
+    """ A parser with the syncs of all parsers, to summarize several
+        Thunderbird instances at once.
+    """
+    merged = ConnectorLogParser()
+    for parser in parsers:
+      merged.syncs.extend(parser.syncs)
+      for name, values in parser.collections.iteritems():
+        merged.collections.setdefault(name, []).extend(values)
+      merged.requests += parser.requests
+      merged.errors.extend(parser.errors)
+    merged.syncs.sort(key=lambda sync: sync["start"])
+    return merged
+
+  def parseTimestamp(self, value):
+    value = value.replace("T", " ").replace(",", ".")
+    value, dot, fraction = value.partition(".")
+    try:
+      seconds = time.mktime(time.strptime(value, self.timestampFormat))
+    except ValueError:
+      return None
+    return seconds + float("0." + fraction) if fraction else seconds
+
+  def feed(self, line, now=None):
+    line = line.rstrip("\r\n")
+    timestamp = None
+    res = self.patterns["timestamp"].search(line)
+    if res:
+      timestamp = self.parseTimestamp(res.group("timestamp"))
+    if timestamp is None:
+      timestamp = time.time() if now is None else now
+
+    if self.patterns["syncStart"].search(line):
+      if self.current:
+        self._endSync(timestamp, complete=False)
+      self.current = OrderedDict([
+        ("start", timestamp), ("end", None), ("duration", None),
+        ("complete", False), ("requests", 0), ("errors", 0),
+        ("collections", OrderedDict())
+      ])
+    elif self.patterns["syncEnd"].search(line):
+      if self.current:
+        self._endSync(timestamp)
+
+    res = self.patterns["collectionStart"].search(line)
+    if res:
+      self.collectionStarts[res.group("collection")] = timestamp
+    res = self.patterns["collectionEnd"].search(line)
+    if res:
+      self._endCollection(res.group("collection"), timestamp)
+
+    if self.patterns["request"].search(line):
+      self.requests += 1
+      if self.current:
+        self.current["requests"] += 1
+
+    if self.patterns["error"].search(line):
+      self.errors.append(line)
+      if self.current:
+        self.current["errors"] += 1
+
+  def feedLines(self, lines, now=None):
+    for line in lines:
+      self.feed(line, now)
+
+  def _endCollection(self, name, timestamp):
+    start = self.collectionStarts.pop(name, None)
+    if start is None:
+      return
+    duration = timestamp - start
+    self.collections.setdefault(name, []).append(duration)
+    if self.current:
+      self.current["collections"][name] = duration
+
+  def _endSync(self, timestamp, complete=True):
+    self.current["end"] = timestamp
+    self.current["duration"] = timestamp - self.current["start"]
+    self.current["complete"] = complete
+    self.syncs.append(self.current)
+    self.current = None
+
+  def summary(self):
+    durations = [x["duration"] for x in self.syncs if x["complete"]]
+    return OrderedDict([
+      ("syncs", statistics(durations)),
+      ("collections", OrderedDict((name, statistics(values))
+                                  for name, values in self.collections.iteritems())),
+      ("requests", self.requests),
+      ("errors", len(self.errors)),
+      ("lastSync", self.syncs[-1]["duration"] if self.syncs else None)
+    ])
+
+  def formatSummary(self):
+    def seconds(value):
+      return "-" if value is None else "%.2fs" % value
+
+    def line(name, stats):
+      return "  %-20s %5d  p50 %8s  p95 %8s  max %8s" % (
+        name, stats["count"], seconds(stats["p50"]),
+        seconds(stats["p95"]), seconds(stats["max"]))
+
+    summary = self.summary()
+    lines = ["Connector sync summary:", line("all syncs", summary["syncs"])]
+    for name, stats in summary["collections"].iteritems():
+      lines.append(line(name, stats))
+    lines.append("  %d requests, %d errors, last sync took %s" % (
+                 summary["requests"], summary["errors"], seconds(summary["lastSync"])))
+    return "\n".join(lines)
+
+  def export(self, path):
+    data = OrderedDict([
+      ("summary", self.summary()),
+      ("syncs", self.syncs + ([self.current] if self.current else [])),
+      ("errors", self.errors)
+    ])
+    with atomicFile(path) as fp:
+      json.dump(data, fp, indent=2)
@@ -1,16 +1,45 @@
 import base64
 import glob
+import logging
 import os
 import shutil
+import struct
 import subprocess
 import sys
 import tempfile
-import virtualenv
 import signal
 
 from ctypes import *
 from ctypes.util import find_library
 
+# The helper process protocol consists of messages made up of a big endian
+# item count followed by the items, each prefixed with its big endian length.
+# Requests are [command, value...], replies are ["ok", result...] or
+# ["error", message]. All values of a batch travel in a single message.
+def writeMessage(fp, items):
+    parts = [struct.pack(">I", len(items))]
+    for item in items:
+        if isinstance(item, unicode):
+            item = item.encode("utf-8")
+        parts.append(struct.pack(">I", len(item)))
+        parts.append(item)
+    fp.write("".join(parts))
+    fp.flush()
+
+def _readExactly(fp, size):
+    data = fp.read(size)
+    if len(data) != size:
+        raise EOFError("NSS helper stream closed")
+    return data
+
+def readMessage(fp):
+    count, = struct.unpack(">I", _readExactly(fp, 4))
+    items = []
+    for i in xrange(count):
+        size, = struct.unpack(">I", _readExactly(fp, 4))
+        items.append(_readExactly(fp, size))
+    return items
+
 class SECItem(Structure):
     _fields_ = [('type',c_uint),('data',c_void_p),('len',c_uint)]
 
@@ -86,23 +115,43 @@ class NSS(object):
         self.libnss = None
 
 class NSSSession(object):
-    def __init__(self, binPath, profilePath, password=None):
-        self.venvDir = tempfile.mkdtemp()
+    # Number of cached worker environments to keep, see DirectoryCache
+    CACHE_ENTRIES = 4
+
+    def __init__(self, binPath, profilePath, password=None, cacheDir=None):
         self.leafName = os.path.basename(__file__)
-        self.binDir = os.path.join(self.venvDir, 'bin')
         self.profilePath = profilePath
         self.password = password
         self.subproc = None
+        self.cached = bool(cacheDir)
+        self.envLock = None
+
+        files = NSSSession.libraryFiles(binPath)
+
+        from tracing import tracer
+        with tracer.span("nss.environment", cached=self.cached):
+            if self.cached:
+                from cache import DirectoryCache, hashFiles
+
+                # The environment depends on the libraries, this script and
+                # the interpreter it was created with.
+                key = hashFiles(files + [__file__], extra=[
+                    os.path.abspath(binPath), sys.executable, sys.version
+                ])
+                # Other obmtools don't evict the environment while this
+                # session may still start the helper from it
+                cache = DirectoryCache(cacheDir, NSSSession.CACHE_ENTRIES)
+                self.envLock = cache.hold(key, lambda venvDir:
+                                          NSSSession.createEnvironment(venvDir, files))
+                self.venvDir = self.envLock.path
+            else:
+                self.venvDir = tempfile.mkdtemp()
+                NSSSession.createEnvironment(self.venvDir, files)
 
-        # create the virtualenv
-        virtualenv.create_environment(self.venvDir,
-            site_packages=True,
-            never_download=True,
-            no_pip=True,
-            no_setuptools=True
-        )
+        self.binDir = os.path.join(self.venvDir, 'bin')
 
-        # copy libraries
+    @staticmethod
+    def libraryFiles(binPath):
         if sys.platform == "linux2":
             dllfiles = "*.so"
         elif sys.platform == "darwin":
@@ -113,12 +162,26 @@ class NSSSession(object):
         files = glob.glob(os.path.join(binPath, dllfiles))
         if not len(files):
             raise Exception("Could not find libraries in " + binPath)
+        return files
+
+    @staticmethod
+    def createEnvironment(venvDir, files):
+        # create the virtualenv, only needed without in-process NSS
+        import virtualenv
+        virtualenv.create_environment(venvDir,
+            site_packages=True,
+            never_download=True,
+            no_pip=True,
+            no_setuptools=True
+        )
 
+        # copy libraries
+        binDir = os.path.join(venvDir, 'bin')
         for filename in files:
-            shutil.copy(filename, self.binDir)
+            shutil.copy(filename, binDir)
 
         # copy our script
-        shutil.copy(__file__, self.binDir)
+        shutil.copy(__file__, binDir)
 
     def __enter__(self):
         self.start()
@@ -126,6 +189,10 @@ class NSSSession(object):
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.stop()
+        if self.cached:
+            # Cached environments are reused by later sessions
+            self.envLock.close()
+            return
         if exc_type is None:
             shutil.rmtree(self.venvDir)
         else:
@@ -135,38 +202,54 @@ class NSSSession(object):
     def childprocess(profilePath):
         nss = None
         signal.signal(signal.SIGTERM, lambda signum,frame: nss.shutdown() if nss else None)
+
+        if sys.platform == "win32":
+            import msvcrt
+            msvcrt.setmode(sys.stdin.fileno(), os.O_BINARY)
+            msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
+
         while True:
-            args = sys.stdin.readline().rstrip().split(" ")
+            try:
+                args = readMessage(sys.stdin)
+            except EOFError:
+                break
             if len(args) < 1:
                 continue
-            # init password if not set
-            if args[0] == "password":
-                nss = NSS(profilePath, args[1])
-                sys.stdout.write("ok\n")
-            elif not nss:
-                nss = NSS(profilePath)
-
-            # now the real commands
-            if args[0] == "encrypt":
-                sys.stdout.write(nss.encryptString(args[1]) + "\n")
-            elif args[0] == "decrypt":
-                if not nss: nss = NSS(profilePath)
-                sys.stdout.write(nss.decryptString(args[1]) + "\n")
-
-            sys.stdout.flush()
+
+            try:
+                # init password if not set
+                if args[0] == "password":
+                    nss = NSS(profilePath, args[1])
+                    reply = []
+                elif not nss:
+                    nss = NSS(profilePath)
+
+                # now the real commands
+                if args[0] == "encrypt":
+                    reply = map(nss.encryptString, args[1:])
+                elif args[0] == "decrypt":
+                    reply = map(nss.decryptString, args[1:])
+                elif args[0] != "password":
+                    raise Exception("Unknown command " + args[0])
+
+                writeMessage(sys.stdout, ["ok"] + reply)
+            except Exception, e:
+                writeMessage(sys.stdout, ["error", str(e)])
 
     def start(self):
         if not self.subproc:
-            executable = os.path.basename(sys.executable)
-            self.subproc = subprocess.Popen([os.path.join(self.binDir, executable),
-                                             os.path.join(self.binDir, self.leafName),
-                                             os.path.abspath(self.profilePath)],
-                                            stdin=subprocess.PIPE,
-                                            stdout=subprocess.PIPE,
-                                            cwd=self.binDir,
-                                            bufsize=0)
-            if self.password:
-                self._command('password', self.password)
+            from tracing import tracer
+            with tracer.span("nss.start", inProcess=False):
+                executable = os.path.basename(sys.executable)
+                self.subproc = subprocess.Popen([os.path.join(self.binDir, executable),
+                                                 os.path.join(self.binDir, self.leafName),
+                                                 os.path.abspath(self.profilePath)],
+                                                stdin=subprocess.PIPE,
+                                                stdout=subprocess.PIPE,
+                                                cwd=self.binDir,
+                                                bufsize=0)
+                if self.password:
+                    self._command('password', self.password)
 
     def stop(self):
         if self.subproc:
@@ -178,16 +261,172 @@ class NSSSession(object):
 
 
     def encrypt(self, data):
-        return self._command("encrypt", data)
+        return self.encrypt_many([data])[0]
     def decrypt(self, data):
-        return self._command("decrypt", data)
+        return self.decrypt_many([data])[0]
+
+    def encrypt_many(self, values):
+        return self._command("encrypt", *values) if len(values) else []
+    def decrypt_many(self, values):
+        return self._command("decrypt", *values) if len(values) else []
 
     def _command(self, *args):
         if not self.subproc:
             self.start()
 
-        self.subproc.stdin.write(" ".join(args) + "\n")
-        return self.subproc.stdout.readline().rstrip()
+        writeMessage(self.subproc.stdin, args)
+        try:
+            reply = readMessage(self.subproc.stdout)
+        except EOFError:
+            raise Exception("NSS helper process exited unexpectedly")
+
+        if reply[0] != "ok":
+            raise Exception("NSS helper error: %s" % reply[1])
+        return reply[1:]
+
+# Libraries libnss3 needs that the Thunderbird executable usually provides
+# through its rpath. They are loaded globally before libnss3 itself.
+NSS_DEPENDENCIES = ["nspr4", "plc4", "plds4", "mozglue", "mozsqlite3",
+                    "nssutil3", "softokn3", "freebl3", "nssdbm3"]
+
+# Dependencies whose symbols must not become visible to the rest of the
+# process. mozsqlite3 exports the sqlite3 API and would replace the library
+# of Python's sqlite3 module. NSS still finds them by their soname.
+NSS_LOCAL_DEPENDENCIES = ["mozsqlite3"]
+
+def libraryName(name):
+    if sys.platform == "darwin":
+        return "lib%s.dylib" % name
+    elif sys.platform == "win32":
+        return "%s.dll" % name
+    else:
+        return "lib%s.so" % name
+
+def libraryBits(path):
+    """ Returns the set of pointer sizes in bits the library was built for. """
+    with open(path, "rb") as fp:
+        header = fp.read(4096)
+
+    if header[:4] == "\x7fELF":
+        return set([{ "\x01": 32, "\x02": 64 }.get(header[4])])
+    elif header[:2] == "MZ":
+        offset, = struct.unpack("<I", header[0x3c:0x40])
+        if header[offset:offset+4] == "PE\0\0":
+            machine, = struct.unpack("<H", header[offset+4:offset+6])
+            return set([{ 0x14c: 32, 0x8664: 64 }.get(machine)])
+
+    magic, = struct.unpack(">I", header[:4])
+    if magic in (0xfeedface, 0xcefaedfe):
+        return set([32])
+    elif magic in (0xfeedfacf, 0xcffaedfe):
+        return set([64])
+    elif magic == 0xcafebabe:
+        # Universal binary, each architecture has a 20 byte fat_arch entry
+        # whose cputype has the CPU_ARCH_ABI64 bit set for 64-bit slices.
+        count, = struct.unpack(">I", header[4:8])
+        bits = set()
+        for i in xrange(count):
+            cputype, = struct.unpack(">I", header[8+i*20:12+i*20])
+            bits.add(64 if cputype & 0x01000000 else 32)
+        return bits
+    return set()
+
+class InProcessNSSSession(object):
+    """ Drop-in replacement for NSSSession that loads NSS into this process.
+
+        NSS can only be initialized for one profile per process, starting a
+        session will stop any other in-process session that is still active.
+    """
+    active = None
+
+    def __init__(self, binPath, profilePath, password=None):
+        self.nssPath = InProcessNSSSession.load(binPath)
+        self.profilePath = profilePath
+        self.password = password
+        self.nss = None
+
+    @staticmethod
+    def supported(binPath):
+        path = os.path.join(binPath, libraryName("nss3"))
+        if not os.path.exists(path):
+            return False
+        return struct.calcsize("P") * 8 in libraryBits(path)
+
+    @staticmethod
+    def load(binPath):
+        # Dependencies may need each other, keep loading until no more
+        # progress is made and let libnss3 report what is still missing.
+        local = [os.path.join(binPath, libraryName(x)) for x in NSS_LOCAL_DEPENDENCIES]
+        pending = [path for path in [os.path.join(binPath, libraryName(x))
+                                     for x in NSS_DEPENDENCIES]
+                   if os.path.exists(path)]
+        while pending:
+            loaded = []
+            for path in pending:
+                try:
+                    CDLL(path, mode=RTLD_LOCAL if path in local else RTLD_GLOBAL)
+                    loaded.append(path)
+                except OSError:
+                    pass
+            if not loaded:
+                break
+            pending = [x for x in pending if x not in loaded]
+
+        nssPath = os.path.join(binPath, libraryName("nss3"))
+        CDLL(nssPath, mode=RTLD_GLOBAL)
+        return nssPath
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        if not self.nss:
+            if InProcessNSSSession.active:
+                InProcessNSSSession.active.stop()
+            from tracing import tracer
+            with tracer.span("nss.start", inProcess=True):
+                self.nss = NSS(os.path.abspath(self.profilePath),
+                               self.password or "", self.nssPath)
+            InProcessNSSSession.active = self
+
+    def stop(self):
+        if self.nss:
+            self.nss.shutdown()
+            self.nss = None
+            InProcessNSSSession.active = None
+
+    def encrypt(self, data):
+        return self.encrypt_many([data])[0]
+    def decrypt(self, data):
+        return self.decrypt_many([data])[0]
+
+    def encrypt_many(self, values):
+        self.start()
+        return [self.nss.encryptString(self._encode(x)) for x in values]
+    def decrypt_many(self, values):
+        self.start()
+        return [self.nss.decryptString(x) for x in values]
+
+    def _encode(self, value):
+        return value.encode("utf-8") if isinstance(value, unicode) else value
+
+def createSession(binPath, profilePath, password=None, cacheDir=None):
+    """ Returns an in-process session if this interpreter can load the NSS
+        libraries in binPath, otherwise a session using a helper process.
+    """
+    if InProcessNSSSession.supported(binPath):
+        try:
+            return InProcessNSSSession(binPath, profilePath, password)
+        except OSError, e:
+            logging.info("Could not load NSS in-process, using a helper process: %s" % e)
+    else:
+        logging.info("NSS libraries in %s do not match this interpreter, using a helper process" % binPath)
+
+    return NSSSession(binPath, profilePath, password, cacheDir)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,91 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import OrderedDict
+import json
+import os
+import re
+
+from utils import atomicFile
+
+class PrefsFile(object):
+  """ An index of the user_pref() lines in prefs.js.
+
+      Each preference is kept once, in the position it first appeared in and
+      with the value it was last set to, which is also how Thunderbird reads
+      the file. Values are kept in their prefs.js notation so that
+      preferences obmtool doesn't know about are written back unchanged.
+  """
+
+  PREF_RE = re.compile(r'^\s*user_pref\(\s*("(?:[^"\\]|\\.)*")\s*,\s*(.*?)\s*\)\s*;\s*$')
+  HEADER = "# Mozilla User Preferences"
+
+  def __init__(self, path):
+    self.path = path
+    self.header = []
+    self.prefs = OrderedDict()
+    self.read()
+    self.dirty = False
+
+  def read(self, fp=None):
+    if fp is None:
+      if os.path.exists(self.path):
+        fp = open(self.path)
+      else:
+        return
+
+    for line in fp:
+      res = PrefsFile.PREF_RE.match(line)
+      if res:
+        self.prefs[json.loads(res.group(1))] = res.group(2)
+      elif not len(self.prefs) and not line.startswith("#MozRunner"):
+        # Keep the comments Thunderbird puts at the top of the file, other
+        # lines (like the mozprofile block markers) are dropped.
+        self.header.append(line.rstrip("\n"))
+
+  @staticmethod
+  def serialize(value):
+    if isinstance(value, bool):
+      return "true" if value else "false"
+    elif isinstance(value, (int, long)):
+      return str(value)
+    else:
+      return json.dumps(value)
+
+  def get(self, name, defaultValue=None):
+    if name not in self.prefs:
+      return defaultValue
+    try:
+      return json.loads(self.prefs[name])
+    except ValueError:
+      return self.prefs[name]
+
+  def set(self, name, value):
+    value = PrefsFile.serialize(value)
+    if self.prefs.get(name) != value:
+      self.prefs[name] = value
+      self.dirty = True
+
+  def update(self, prefs):
+    if isinstance(prefs, dict):
+      prefs = prefs.items()
+    for name, value in prefs or []:
+      self.set(name, value)
+
+  def write(self, fp=None):
+    if fp is None:
+      if not self.dirty:
+        return
+      with atomicFile(self.path) as fp:
+        self.write(fp)
+      self.dirty = False
+      return
+
+    header = self.header
+    if not any(line.strip() for line in header):
+      header = [PrefsFile.HEADER, ""]
+
+    fp.write("\n".join(header) + "\n")
+    for name, value in self.prefs.iteritems():
+      fp.write("user_pref(%s, %s);\n" % (json.dumps(name), value))
@@ -4,48 +4,178 @@
 # Portions Copyright (C) Philipp Kewisch, 2013
 
 from mozprofile.profile import ThunderbirdProfile
-from mozprofile.addons import AddonManager
 import mozfile
 
 from urlparse import urlparse
+import hashlib
+import logging
 import os.path
 import sys
 import time
 
+from addons import AddonCache, addonHash
+from cache import DirectoryCache, breakLink, cloneTree
 from certificates import CertOverrideFile, CertOverrideEntry
-from signons import SignonsSQLFile, Signons3File
+from prefs import PrefsFile
+from signons import SignonsSQLFile, Signons3File, SignonFileEntry
+from tracing import tracer
 
 class ObmProfile(ThunderbirdProfile):
+  # Bump this when the way profiles are set up changes, so that templates
+  # created by older versions are not used.
+  TEMPLATE_VERSION = 1
+
+  # Number of profile templates to keep, see DirectoryCache
+  TEMPLATE_ENTRIES = 8
+
+  # Files that are specific to a profile instance and are not templated
+  TEMPLATE_IGNORE = ("lock", ".parentlock", "parent.lock", "obm-connector-log.txt")
+
+  # Preferences that change with every run, like the jsbridge port of each
+  # mozmill shard. They are left out of the template key, initClone writes
+  # them to the clone.
+  RUN_PREFERENCES = ("extensions.jsbridge.port",)
+
+  # Files of a clone that are written in place instead of being replaced
+  SHARED_FILES = ("signons.sqlite", "signons.sqlite-journal", "signons.sqlite-wal",
+                  "signons3.txt")
+
   def __init__(self, userName, password, serverUri,
-               tbVersion, binary, cachePath="profileCache", reset=False, *args, **kwargs):
-    self.profileName = "%s-tb%d-%s" % (userName, tbVersion, time.strftime("%Y-%m-%d", time.localtime()))
+               tbVersion, binary, cachePath="profileCache", reset=False,
+               nssCache=None, templateCache=None, addonCache=None,
+               instance=None, prepared=False, standIn=False, *args, **kwargs):
+    self.profileName = ObmProfile.profileNameFor(userName, tbVersion, instance)
     profilePath = os.path.join(cachePath, self.profileName)
+    self.userName = userName
+    self.password = password
+    self.serverUri = serverUri
+    self.tbVersion = tbVersion
+    self.binPath = os.path.dirname(binary)
+    self.nssCache = nssCache
+    self.standIn = standIn
+    self._signons = None
+
+    if prepared:
+      # The profile was set up completely by obmtool serve, it only needs
+      # to be opened. See obmtool.daemon.
+      kwargs.pop('addons', None)
+      kwargs.pop('preferences', None)
+      self.addonCache = self.cachedAddons = None
+      super(ObmProfile, self).__init__(profile=profilePath, *args, **kwargs)
+      self.overrides = CertOverrideFile(os.path.join(profilePath,"cert_override.txt"))
+      return
 
     if reset:
       print "Reseting profile in",profilePath
       mozfile.remove(profilePath)
 
-    super(ObmProfile, self).__init__(profile=profilePath, *args, **kwargs)
-    self.userName = userName
-    self.password = password
-    self.serverUri = serverUri
-    self.tbVersion = tbVersion
+    # With an add-on cache the add-ons are linked in by us instead of being
+    # copied by mozprofile.
+    self.addonCache = AddonCache(addonCache) if addonCache else None
+    self.cachedAddons = kwargs.pop('addons', None) if addonCache else None
+
+    # New profiles are cloned from a template built with the same
+    # configuration, if there is one. Only the per-profile settings written
+    # by initClone differ between the clones.
+    templates = None
+    cloned = False
+    created = not os.path.exists(profilePath)
+    if templateCache and created:
+      templates = DirectoryCache(templateCache, ObmProfile.TEMPLATE_ENTRIES)
+      templateKey = ObmProfile.templateKey(userName, password, serverUri,
+                                           tbVersion, binary,
+                                           self.cachedAddons or kwargs.get('addons'),
+                                           kwargs.get('preferences'))
+      template = templates.hold(templateKey)
+      if template:
+        logging.info("Creating profile from template %s" % template.path)
+        with template, tracer.span("profile.cloneTemplate"):
+          cloneTree(os.path.join(template.path, "profile"), profilePath,
+                    linkDirs=["extensions"])
+        templates = None
+        cloned = True
+
+    if cloned:
+      # The add-ons and certificates came with the template. mozprofile must
+      # not install the add-ons again, that could write through the links
+      # into the template and the add-on cache.
+      kwargs.pop('addons', None)
+      preferences = kwargs.pop('preferences', None) or {}
+      with tracer.span("profile.mozprofile"):
+        super(ObmProfile, self).__init__(profile=profilePath, *args, **kwargs)
+      self._preferences = preferences
+      self.overrides = CertOverrideFile(os.path.join(profilePath,"cert_override.txt"))
+      with tracer.span("profile.init"):
+        self.initClone()
+      self.flush()
+      return
 
-    # Thunderbird 3 doesn't have 64-bit NSS libraries on mac, use the old
-    # signons file for this version
-    if self.tbVersion > 3:
-      self.signons = SignonsSQLFile(profilePath, os.path.dirname(binary))
-    else:
-      self.signons = Signons3File(os.path.join(profilePath, "signons3.txt"))
+    with tracer.span("profile.mozprofile"):
+      super(ObmProfile, self).__init__(profile=profilePath, *args, **kwargs)
+    with tracer.span("profile.addons"):
+      self.installCachedAddons()
 
     self.overrides = CertOverrideFile(os.path.join(profilePath,"cert_override.txt"))
 
-    self.initProfile()
+    with tracer.span("profile.init"):
+      self.initProfile()
     self.flush()
 
+    if templates:
+      logging.info("Saving profile template for %s" % self.profileName)
+      with tracer.span("profile.storeTemplate"):
+        templates.store(templateKey, lambda path:
+                        cloneTree(profilePath, os.path.join(path, "profile"),
+                                  linkDirs=["extensions"],
+                                  ignore=ObmProfile.TEMPLATE_IGNORE))
+
+  @staticmethod
+  def profileNameFor(userName, tbVersion, instance=None):
+    profileName = "%s-tb%d-%s" % (userName, tbVersion, time.strftime("%Y-%m-%d", time.localtime()))
+    if instance:
+      # Parallel instances for the same user each need their own profile
+      profileName += "-%d" % instance
+    return profileName
+
+  @staticmethod
+  def templateKey(userName, password, serverUri, tbVersion, binary,
+                  addons=None, preferences=None):
+    if isinstance(preferences, dict):
+      preferences = preferences.items()
+    preferences = [(name, value) for name, value in preferences or []
+                   if name not in ObmProfile.RUN_PREFERENCES]
+
+    digest = hashlib.sha1()
+    for value in [ObmProfile.TEMPLATE_VERSION, userName,
+                  hashlib.sha1(password or "").hexdigest(), serverUri,
+                  tbVersion, os.path.abspath(binary),
+                  sorted(preferences or [])]:
+      digest.update(repr(value) + "\0")
+    for addon in addons or []:
+      digest.update(addonHash(addon) + "\0")
+    return digest.hexdigest()
+
+  @property
+  def signons(self):
+    # Opened on first use, a prepared profile doesn't need NSS at all
+    if self._signons is None:
+      # Thunderbird 3 doesn't have 64-bit NSS libraries on mac, use the old
+      # signons file for this version
+      if self.tbVersion > 3:
+        self._signons = SignonsSQLFile(self.profile, self.binPath,
+                                       nssCache=self.nssCache)
+      else:
+        self._signons = Signons3File(os.path.join(self.profile, "signons3.txt"))
+    return self._signons
+
+  def installCachedAddons(self):
+    for addon in self.cachedAddons or []:
+      self.addonCache.install(addon, self.profile)
+
   def flush(self):
-    self.overrides.write()
-    self.signons.write()
+    with tracer.span("profile.flush"):
+      self.overrides.write()
+      self.signons.write()
 
   @property
   def connectorLog(self):
@@ -54,9 +184,26 @@ class ObmProfile(ThunderbirdProfile):
 
   def reset(self):
     super(ObmProfile, self).reset()
+    self.installCachedAddons()
     self.initProfile()
 
   def initProfile(self):
+    self.writePrefs()
+    self.addUserSignons()
+    self.addServerOverrides()
+
+  def initClone(self):
+    """ Sets up a profile cloned from a template. Only the prefs and the
+        signons of the user are written again, the prefs contain the
+        absolute profile path. The certificates are the template's.
+    """
+    # Files that are changed in place must not be shared with the template
+    for name in ObmProfile.SHARED_FILES:
+      breakLink(os.path.join(self.profile, name))
+    self.writePrefs()
+    self.addUserSignons()
+
+  def writePrefs(self):
     absProfilePath = os.path.abspath(self.profile)
     serverUri = urlparse(self.serverUri)
     userEmail = "%s@%s" % (self.userName, serverUri.hostname)
@@ -109,30 +256,47 @@ class ObmProfile(ThunderbirdProfile):
     }
 
     # Set up prefs.js. Need to set self._preferences again because mozprofile
-    # defaults to user.js, which doesn't seem to work with Thunderbird.
-    self.set_preferences(prefs.items(), 'prefs.js')
-    self.set_preferences(self._preferences, 'prefs.js')
+    # defaults to user.js, which doesn't seem to work with Thunderbird. The
+    # file is rewritten in place instead of appending a block each time.
+    prefsFile = PrefsFile(os.path.join(absProfilePath, "prefs.js"))
+    prefsFile.update(prefs)
+    prefsFile.update(self._preferences)
+    prefsFile.write()
+
+  def addUserSignons(self):
+    serverUri = urlparse(self.serverUri)
+    userEmail = "%s@%s" % (self.userName, serverUri.hostname)
 
     # Add saved passwords
     password = self.password or self.userName
-    self.signons.addEntry(
-      hostname="obm-obm-obm",
-      httpRealm="obm-obm-obm",
-      user=self.userName, password=password
-    )
-    self.signons.addEntry(
-      hostname="imap://%s" % serverUri.hostname,
-      httpRealm="imap://%s" % serverUri.hostname,
-      user=userEmail, password=password
-    )
-    self.signons.addEntry(
-      hostname="smtp://%s" % serverUri.hostname,
-      httpRealm="smtp://%s" % serverUri.hostname,
-      user=userEmail, password=password
-    )
-
-    # Create certificate overrides
-    self.overrides.add(CertOverrideEntry.fromHost(serverUri.hostname, 443))
-    hackedEntry = CertOverrideEntry.fromHost(serverUri.hostname, 443)
-    hackedEntry.port = 143
-    self.overrides.add(hackedEntry)
+    self.signons.addEntries([
+      SignonFileEntry(
+        hostname="obm-obm-obm",
+        httpRealm="obm-obm-obm",
+        user=self.userName, password=password
+      ),
+      SignonFileEntry(
+        hostname="imap://%s" % serverUri.hostname,
+        httpRealm="imap://%s" % serverUri.hostname,
+        user=userEmail, password=password
+      ),
+      SignonFileEntry(
+        hostname="smtp://%s" % serverUri.hostname,
+        httpRealm="smtp://%s" % serverUri.hostname,
+        user=userEmail, password=password
+      )
+    ])
+
+  def addServerOverrides(self):
+    serverUri = urlparse(self.serverUri)
+
+    # Create certificate overrides. IMAP uses the same certificate as https,
+    # so the entry for port 143 is a copy of the one for 443. The stand-in
+    # server of obmtool load has no certificate.
+    if self.standIn:
+      return
+    entry = CertOverrideEntry.fromHost(serverUri.hostname, 443)
+    self.overrides.add(entry)
+    self.overrides.add(CertOverrideEntry(serverUri.hostname, 143,
+                                         entry.fingerprint, entry.certtype,
+                                         entry.issuerSerialHash))
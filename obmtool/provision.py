@@ -0,0 +1,194 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from multiprocessing.pool import ThreadPool
+from urlparse import urlparse
+import argparse
+import copy
+import csv
+import multiprocessing
+import os
+import re
+import sys
+import time
+import traceback
+
+from addons import AddonCache
+from certificates import CertOverrideEntry
+from config import config
+from nss import createSession
+from profile import ObmProfile
+import certificates
+import utils
+
+def readUsers(path):
+  """ Reads (user, password, server) tuples from a CSV file. The columns are
+      user, password and server unless the first row names them. Empty
+      passwords and servers use the obmtool defaults. Each user may only be
+      listed once, the profiles are named after the user.
+  """
+  with open(path, "rb") as fp:
+    rows = [row for row in csv.reader(fp)
+            if row and row[0].strip() and not row[0].startswith("#")]
+
+  columns = ["user", "password", "server"]
+  if rows and "user" in [x.strip().lower() for x in rows[0]]:
+    columns = [x.strip().lower() for x in rows.pop(0)]
+
+  users = []
+  seen = set()
+  for row in rows:
+    entry = dict(zip(columns, [x.strip() for x in row]))
+    if entry["user"] in seen:
+      raise Exception("User %s is listed more than once in %s" % (entry["user"], path))
+    seen.add(entry["user"])
+    users.append((entry["user"], entry.get("password") or None,
+                  entry.get("server") or None))
+  return users
+
+def prefetch(args, users):
+  """ Does the work that is the same for all users once, before the
+      workers start: certificates, unpacking add-ons and the NSS helper.
+  """
+  hosts = set()
+  for user, password, server in users:
+    if not (server or args.server):
+      # Reported as a failure when the profile is built
+      continue
+    if not args.standIn:
+      hosts.add((urlparse(server or args.server).hostname, 443))
+  for cert in filter(bool, re.split("[,\n]", config.get("profile", "certificates", ""))):
+    host, port = cert.split(":")
+    hosts.add((host, int(port)))
+
+  def fetch(hostport):
+    try:
+      CertOverrideEntry.fromHost(hostport[0], hostport[1],
+                                 timeout=config.get("defaults", "certificateTimeout", 10))
+    except Exception, e:
+      print "Could not get certificate from %s:%d: %s" % (hostport[0], hostport[1], e)
+
+  pool = ThreadPool(min(8, len(hosts)) or 1)
+  try:
+    pool.map(fetch, list(hosts))
+  finally:
+    pool.close()
+    pool.join()
+
+  if args.addonCache:
+    addons = AddonCache(args.addonCache)
+    for addon in args.extension:
+      addons.unpack(addon)
+
+  # Builds the cached helper environment if NSS can't be used in-process
+  createSession(os.path.dirname(args.thunderbird), args.cachePath,
+                cacheDir=args.nssCache)
+
+  certificates.cache.save()
+  utils.metadata.save()
+
+# The arguments all profiles are built with, set in each worker process
+workerArgs = None
+
+def initWorker(args, certificateCache, metadataCache):
+  global workerArgs
+  workerArgs = args
+
+  # Worker processes may not share the parent's memory, so the caches the
+  # parent filled are read again.
+  certificates.cache.open(certificateCache,
+                          config.get("defaults", "certificateTTL", 86400))
+  utils.metadata.open(metadataCache)
+
+def provisionUser(user):
+  from obmtool.app import profileArgs, setupProfile
+
+  userName, password, server, instance = user
+  start = time.time()
+  try:
+    args = copy.copy(workerArgs)
+    args.user = userName
+    args.password = password or args.password
+    args.server = server or args.server
+    args.instance = instance
+    if not args.server:
+      raise Exception("No server for %s, add one to the users file or the config" % userName)
+
+    profile = ObmProfile(restore=False, **profileArgs(args))
+    setupProfile(profile)
+    return (userName, instance), profile.profile, time.time() - start, None
+  except Exception, e:
+    return (userName, instance), None, time.time() - start, "%s\n%s" % (e, traceback.format_exc())
+
+def provisionProfiles(args, users, jobs):
+  """ Builds the profiles for (user, password, server, instance) tuples in
+      jobs processes. Returns the paths of the profiles that were built, by
+      user and instance, and a list of (user, error) for those that failed.
+  """
+  prefetch(args, [user[:3] for user in users])
+
+  pool = multiprocessing.Pool(max(jobs, 1), initWorker,
+                              (args, certificates.cache.path, utils.metadata.path))
+  built = {}
+  failures = []
+  try:
+    for user, path, elapsed, error in pool.imap_unordered(provisionUser, users):
+      userName, instance = user
+      if error:
+        failures.append((userName, error))
+        print "Failed %s after %.1fs: %s" % (userName, elapsed, error.splitlines()[0])
+      else:
+        built[user] = path
+        if args.verbose:
+          print "Built %s in %.1fs: %s" % (userName, elapsed, path)
+  except KeyboardInterrupt:
+    pool.terminate()
+    pool.join()
+    raise
+  pool.close()
+  pool.join()
+  return built, failures
+
+def provision(argv):
+  from obmtool.app import createParser, setupArgs
+
+  parser = argparse.ArgumentParser(prog="obmtool provision", description="Set up profiles for many OBM users at once. The obmtool arguments given after the options are used for all profiles.")
+  parser.add_argument('--users', required=True, metavar='FILE', help="CSV file with the user, password and server of each profile")
+  parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(), help="Number of profiles to build in parallel (default: number of CPUs)")
+  parser.add_argument('args', nargs=argparse.REMAINDER, help="obmtool arguments, after --")
+  options = parser.parse_args(argv)
+  if options.args[:1] == ["--"]:
+    options.args = options.args[1:]
+
+  args = createParser().parse_args(options.args)
+  setupArgs(args)
+
+  # Templates are per user, storing one per profile would only evict the
+  # templates of interactive use.
+  args.templateCache = None
+
+  try:
+    users = readUsers(options.users)
+  except Exception, e:
+    print e
+    sys.exit(1)
+  if not len(users):
+    print "No users in %s" % options.users
+    sys.exit(1)
+
+  print "Provisioning %d profiles with %d jobs..." % (len(users), options.jobs)
+  start = time.time()
+  built, failures = provisionProfiles(args, [user + (None,) for user in users],
+                                      options.jobs)
+
+  elapsed = time.time() - start
+  print "Provisioned %d of %d profiles in %.1fs (%.2f profiles/sec)" % (
+        len(built), len(users), elapsed, len(built) / elapsed if elapsed else 0)
+  if failures:
+    print "%d failed:" % len(failures)
+    for userName, error in failures:
+      print "  %s: %s" % (userName, error.splitlines()[0])
+      if args.verbose:
+        print "    " + "\n    ".join(error.splitlines()[1:])
+    sys.exit(1)
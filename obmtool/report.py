@@ -5,105 +5,196 @@
 # This class is taken from here, with a few modifications:
 #   https://github.com/mozilla/mozmill-automation/blob/master/mozmill_automation/reports.py
 
-from datetime import datetime
 import os
-import xml.dom.minidom
+from xml.sax.saxutils import XMLGenerator, quoteattr
 
 from mozmill.report import Report
 
+def _unicode(value):
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return unicode(value)
+
+class JUnitWriter(object):
+    """ Writes a JUnit testsuite one testcase at a time.
+
+        The closing tag is written after every testcase and overwritten by
+        the next one, so the file is a complete report even if the process
+        dies half way through. The summary attributes are written into space
+        reserved in the opening tag once the suite is finished.
+    """
+
+    CLOSE = '</testsuite>\n'
+    RESERVED = 64
+
+    def __init__(self, fp, report_type):
+        self.fp = fp
+        self.report_type = report_type
+        self.tests = 0
+        self.failures = 0
+        self.skips = 0
+        self.time = 0
+
+        self.fp.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        self.header_pos = self.fp.tell()
+        self.header_size = len(self._header()) + self.RESERVED
+        self._write_header()
+
+        self.generator = XMLGenerator(self.fp, 'utf-8')
+        self._close_suite()
+
+    def _header(self):
+        attributes = [('name', self.report_type), ('errors', 0),
+                      ('failures', self.failures), ('skips', self.skips),
+                      ('tests', self.tests), ('time', self.time)]
+        return '<testsuite ' + ' '.join(['%s=%s' % (key, quoteattr(str(value)))
+                                         for key, value in attributes])
+
+    def _write_header(self):
+        self.fp.write(self._header().ljust(self.header_size) + '>\n')
+
+    def _close_suite(self):
+        self.body_pos = self.fp.tell()
+        self.fp.write(self.CLOSE)
+        self.fp.flush()
+        self.fp.seek(self.body_pos)
+
+    def add_result(self, result):
+        filename = result['filename']
+        root_path = 'tests/%s' % self.report_type
+
+        # replace backslashes with forward slashes
+        filename = filename.replace('\\', '/')
+
+        # strip temporary and common path elements, and strip trailing forward slash
+        class_name = filename.partition(root_path)[2].lstrip('/')
+
+        # strip the file extension
+        class_name = os.path.splitext(class_name)[0]
+
+        # replace periods with underscore to avoid them being interpreted as package seperators
+        class_name = class_name.replace('.', '_')
+
+        # replace path separators with periods to give implied package hierarchy
+        class_name = class_name.replace('/', '.')
+
+        time = '0'
+        if 'time_start' in result and 'time_end' in result:
+            time = str((result['time_end'] - result['time_start']) / 1000)
+
+        self.tests += 1
+        self.generator.startElement('testcase', {
+            u'classname': _unicode(class_name),
+            u'name': _unicode(result['name']).rpartition('::')[2],
+            u'time': _unicode(time)
+        })
+
+        # Resources used by the test, see obmtool.resources.TestResources
+        if result.get('resources'):
+            self.generator.startElement('properties', {})
+            for name, value in result['resources'].iteritems():
+                self.generator.startElement('property', {
+                    u'name': _unicode(name),
+                    u'value': _unicode(value)
+                })
+                self.generator.endElement('property')
+            self.generator.endElement('properties')
+
+        if 'skipped' in result and result['skipped']:
+            self.skips += 1
+            reason = _unicode(result['skipped_reason'])
+            self.generator.startElement('skipped', { u'message': reason })
+            self.generator.characters(reason)
+            self.generator.endElement('skipped')
+        elif result['failed']:
+            self.failures += 1
+
+            # If result['fails'] is not a list, make it a list of one
+            result_failures = result['fails']
+            if not isinstance(result_failures, list):
+                result_failures = [result_failures]
+
+            failures = []
+            for failure in result_failures:
+                # If the failure is a dict then return the appropriate exception/failure item or return an empty dict
+                failure_data = isinstance(failure, dict) and (
+                    'exception' in failure and failure['exception'] or
+                    'fail' in failure and failure['fail']) or {}
+                message = failure_data.get('message', 'Unknown failure.')
+                stack = failure_data.get('stack', 'Stack unavailable.')
+                failures.append({'message': message, 'stack': stack})
+
+            if len(failures) == 1:
+                message = failures[0]['message']
+                body = failures[0]['stack']
+            else:
+                message = '%d failures' % len(failures)
+                body = '\n\n'.join(['Message: %s\nStack: %s' % (failure['message'], failure['stack']) for failure in failures])
+            self.generator.startElement('failure', { u'message': _unicode(message) })
+            self.generator.characters(_unicode(body))
+            self.generator.endElement('failure')
+
+        self.generator.endElement('testcase')
+        self.generator.ignorableWhitespace(u'\n')
+        self._close_suite()
+
+    def close(self, time=None):
+        """ Fills in the summary attributes, the file is left open. """
+        if time is not None:
+            self.time = time
+        self.fp.seek(self.header_pos)
+        self._write_header()
+        self.fp.seek(0, os.SEEK_END)
+        self.fp.flush()
+
 class JUnitReport(Report):
 
     def __init__(self, report, testrun):
         Report.__init__(self, report)
 
         self.testrun = testrun
+        self.writer = None
+
+    def events(self):
+        return { 'mozmill.endTest': self.end_test }
+
+    def _open(self):
+        if self.writer is None:
+            fp = open(self.report, 'wb')
+            self.writer = JUnitWriter(fp, str(self.testrun.report_type))
+        return self.writer
+
+    def end_test(self, test):
+        """ Append the result to the report as soon as the test is done. """
+        if self.report:
+            self._open().add_result(test)
+
+    def stop(self, results, fatal):
+        """ Finish the JUnit XML report. """
+        if not self.report:
+            return
+
+        if self.writer is None:
+            # No events were received, i.e. for merged results
+            writer = self._open()
+            for result in results.alltests:
+                writer.add_result(result)
+
+        self.writer.close(self._suite_time(results))
+        self.writer.fp.close()
+
+    def _suite_time(self, results):
+        if getattr(results, 'starttime', None) and getattr(results, 'endtime', None):
+            return (results.endtime - results.starttime).seconds
+        return None
 
     def get_report(self, results):
         """ Generate JUnit XML report. """
-        report = Report.get_report(self, results)
-
-        report_type = str(self.testrun.report_type)
-        time_start = datetime.strptime(report['time_start'], self.date_format)
-        time_end = datetime.strptime(report['time_end'], self.date_format)
-
-        doc = xml.dom.minidom.Document()
-        testsuite_element = doc.createElement('testsuite')
-        testsuite_element.setAttribute('name', report_type)
-        testsuite_element.setAttribute('errors', "0")
-        testsuite_element.setAttribute('failures', str(report['tests_failed']))
-        testsuite_element.setAttribute('skips', str(report['tests_skipped']))
-        testsuite_element.setAttribute('tests', str(len(report['results'])))
-        testsuite_element.setAttribute('time', str((time_end - time_start).seconds))
-
-        for result in report['results']:
-            filename = result['filename']
-            root_path = 'tests/%s' % report_type
-
-            # replace backslashes with forward slashes
-            filename = filename.replace('\\', '/')
-
-            # strip temporary and common path elements, and strip trailing forward slash
-            class_name = filename.partition(root_path)[2].lstrip('/')
-
-            # strip the file extension
-            class_name = os.path.splitext(class_name)[0]
-
-            # replace periods with underscore to avoid them being interpreted as package seperators
-            class_name = class_name.replace('.', '_')
-
-            # replace path separators with periods to give implied package hierarchy
-            class_name = class_name.replace('/', '.')
-
-            testcase_element = doc.createElement('testcase')
-            testcase_element.setAttribute('classname', str(class_name))
-            testcase_element.setAttribute('name', str(result['name']).rpartition('::')[2])
-
-            time = '0'
-            if 'time_start' in result and 'time_end' in result:
-                time = str((result['time_end'] - result['time_start']) / 1000)
-            testcase_element.setAttribute("time", time)
-
-            if 'skipped' in result and result['skipped']:
-                skipped_element = doc.createElement('skipped')
-                skipped_element.setAttribute('message', str(result['skipped_reason']))
-                skipped_element.appendChild(doc.createTextNode(str(result['skipped_reason'])))
-                testcase_element.appendChild(skipped_element)
-            elif result['failed']:
-                # If result['fails'] is not a list, make it a list of one
-                result_failures = result['fails']
-                if not isinstance(result_failures, list):
-                    result_failures = [result_failures]
-
-                failures = []
-                for failure in result_failures:
-                    # If the failure is a dict then return the appropriate exception/failure item or return an empty dict
-                    failure_data = isinstance(failure, dict) and (
-                        'exception' in failure and failure['exception'] or
-                        'fail' in failure and failure['fail']) or {}
-                    message = failure_data.get('message', 'Unknown failure.')
-                    stack = failure_data.get('stack', 'Stack unavailable.')
-                    failures.append({'message': message, 'stack': stack})
-
-                if len(failures) == 1:
-                    (message, body) = failures[0].values()
-                else:
-                    message = '%d failures' % len(failures)
-                    body = '\n\n'.join(['Message: %s\nStack: %s' % (failure['message'], failure['stack']) for failure in failures])
-                failed_element = doc.createElement("failure")
-                failed_element.setAttribute('message', unicode(message).encode('ascii', 'xmlcharrefreplace'))
-                failed_element.appendChild(doc.createTextNode(unicode(body).encode('ascii', 'xmlcharrefreplace')))
-                testcase_element.appendChild(failed_element)
-            testsuite_element.appendChild(testcase_element)
-
-        doc.appendChild(testsuite_element)
-        return doc.toxml(encoding='utf-8')
-
-    def send_report(self, results, filename):
-        """ Write JUnit report to file. """
-        try:
-            f = file(filename, 'w')
-        except Exception, e:
-            print "Printing results to '%s' failed (%s)." % (filename, e)
-            return
-        print >> f, results
-        return
+        from cStringIO import StringIO
+
+        fp = StringIO()
+        writer = JUnitWriter(fp, str(self.testrun.report_type))
+        for result in results.alltests:
+            writer.add_result(result)
+        writer.close(self._suite_time(results))
+        return fp.getvalue()
@@ -0,0 +1,253 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import OrderedDict
+import csv
+import json
+import os
+import threading
+import time
+
+from utils import atomicFile
+
+PROC = "/proc"
+
+# Columns of a sample, rss in bytes and cpu in seconds since the start
+COLUMNS = ["time", "processes", "rss", "cpu", "cpuPercent", "threads", "fds"]
+
+try:
+  CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+  PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError, OSError):
+  CLOCK_TICKS = PAGE_SIZE = None
+
+def available():
+  return PAGE_SIZE is not None and os.path.isdir(os.path.join(PROC, "self"))
+
+def readStat(pid):
+  """ Returns the parent pid, cpu seconds, threads and rss bytes of a
+      process, or None if it is gone. The cpu time includes the children
+      it has already waited for.
+  """
+  try:
+    with open(os.path.join(PROC, str(pid), "stat"), "rb") as fp:
+      data = fp.read()
+  except IOError:
+    return None
+
+  # The command name is in parentheses and may contain anything
+  fields = data[data.rindex(")") + 2:].split()
+  ppid = int(fields[1])
+  cpu = sum(int(x) for x in fields[11:15]) / float(CLOCK_TICKS)
+  return ppid, cpu, int(fields[17]), int(fields[21]) * PAGE_SIZE
+
+def countFds(pid):
+  try:
+    return len(os.listdir(os.path.join(PROC, str(pid), "fd")))
+  except OSError:
+    return 0
+
+def processTree(pid):
+  """ Returns the stats of pid and all of its descendants by pid. """
+  stats = {}
+  for name in os.listdir(PROC):
+    if name.isdigit():
+      stat = readStat(int(name))
+      if stat:
+        stats[int(name)] = stat
+
+  tree = {}
+  pending = [pid]
+  while pending:
+    current = pending.pop()
+    if current in stats and current not in tree:
+      tree[current] = stats[current]
+      pending.extend(child for child, stat in stats.iteritems()
+                     if stat[0] == current)
+  return tree
+
+def sampleTree(pid):
+  """ Sums up the resources used by pid and its descendants right now. """
+  tree = processTree(pid)
+  return OrderedDict([
+    ("time", time.time()),
+    ("processes", len(tree)),
+    ("rss", sum(stat[3] for stat in tree.itervalues())),
+    ("cpu", sum(stat[1] for stat in tree.itervalues())),
+    ("threads", sum(stat[2] for stat in tree.itervalues())),
+    ("fds", sum(countFds(child) for child in tree))
+  ])
+
+def megabytes(value):
+  return value / 1048576.0
+
+class ResourceSampler(object):
+  """ Samples the resources of a process tree in the background.
+
+      getPid is called for every sample, so that the tree can be followed
+      across restarts of the process. Times are relative to the start of
+      the sampler, cpu times are added up across restarts.
+  """
+
+  def __init__(self, getPid, interval=1.0):
+    self.getPid = getPid
+    self.interval = interval
+    self.samples = []
+    self.lock = threading.Lock()
+    self.stopped = threading.Event()
+    self.thread = None
+    self.start = None
+
+    self.pid = None
+    self.cpuOffset = 0
+    self.lastCpu = 0
+
+  def sample(self):
+    with self.lock:
+      return self._sample()
+
+  def _sample(self):
+    pid = self.getPid()
+    if not pid:
+      return None
+
+    current = sampleTree(pid)
+    if not current["processes"]:
+      return None
+
+    if pid != self.pid:
+      # A new process, keep counting cpu time from where the last one ended
+      self.pid = pid
+      self.cpuOffset = self.lastCpu
+    current["cpu"] += self.cpuOffset
+    current["time"] -= self.start
+
+    previous = self.samples[-1] if self.samples else None
+    if previous and current["time"] > previous["time"]:
+      current["cpuPercent"] = max(current["cpu"] - previous["cpu"], 0) * 100 / \
+                              (current["time"] - previous["time"])
+    else:
+      current["cpuPercent"] = 0.0
+    self.lastCpu = current["cpu"]
+    self.samples.append(current)
+    return current
+
+  def run(self):
+    while not self.stopped.is_set():
+      try:
+        self.sample()
+      except (IOError, OSError):
+        # The process ended while it was being sampled
+        pass
+      self.stopped.wait(self.interval)
+
+  def begin(self):
+    if self.thread:
+      return
+    self.start = time.time()
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def end(self):
+    self.stopped.set()
+    if self.thread:
+      self.thread.join()
+
+  def peaks(self):
+    if not self.samples:
+      return None
+    peaks = OrderedDict((column, max(sample[column] for sample in self.samples))
+                        for column in COLUMNS[1:])
+    peaks["cpu"] = self.samples[-1]["cpu"]
+    peaks["rssFirst"] = self.samples[0]["rss"]
+    peaks["rssLast"] = self.samples[-1]["rss"]
+    return peaks
+
+  def formatPeaks(self):
+    peaks = self.peaks()
+    if not peaks:
+      return "No resource samples taken"
+    return "\n".join([
+      "Resource use over %d samples:" % len(self.samples),
+      "  peak rss %.1f MB (first %.1f MB, last %.1f MB)" % (
+        megabytes(peaks["rss"]), megabytes(peaks["rssFirst"]), megabytes(peaks["rssLast"])),
+      "  cpu %.1fs, peak %.0f%%" % (peaks["cpu"], peaks["cpuPercent"]),
+      "  peak %d processes, %d threads, %d open files" % (
+        peaks["processes"], peaks["threads"], peaks["fds"])
+    ])
+
+  def save(self, path):
+    """ Writes the samples as CSV if path ends with .csv, otherwise as JSON
+        with the peaks.
+    """
+    with atomicFile(path, "wb") as fp:
+      if path.endswith(".csv"):
+        writer = csv.writer(fp)
+        writer.writerow(COLUMNS)
+        for sample in self.samples:
+          writer.writerow([sample[column] for column in COLUMNS])
+      else:
+        json.dump(OrderedDict([
+          ("interval", self.interval),
+          ("peaks", self.peaks()),
+          ("samples", self.samples)
+        ]), fp, indent=2)
+
+class TestResources(object):
+  """ A mozmill event handler that adds the resources used by the process
+      tree to the result of each test, as resources: the change in RSS from
+      the start to the end of the test, the peak RSS while it ran and the
+      cpu seconds it took.
+
+      It needs to be the first handler, so that the reports and loggers see
+      the resources in the test results.
+  """
+
+  # Seconds between the samples taken to find the peak RSS of a test
+  PEAK_INTERVAL = 0.25
+
+  def __init__(self, getPid, interval=PEAK_INTERVAL):
+    self.sampler = ResourceSampler(getPid, interval)
+    self.current = None
+    self.first = None
+
+  def events(self):
+    # Older mozmill versions announce a test with setTest
+    return { 'mozmill.setTest': self.start_test,
+             'mozmill.startTest': self.start_test,
+             'mozmill.endTest': self.end_test }
+
+  def start_test(self, test):
+    name = test.get('name') if isinstance(test, dict) else test
+    if self.first and self.current == name:
+      return
+
+    self.sampler.begin()
+    with self.sampler.lock:
+      # Only the samples of the current test are needed
+      del self.sampler.samples[:]
+      self.first = self.sampler._sample()
+    self.current = name
+
+  def end_test(self, test):
+    first = self.first
+    self.current = self.first = None
+    if first is None or not isinstance(test, dict):
+      return
+
+    with self.sampler.lock:
+      last = self.sampler._sample()
+      samples = list(self.sampler.samples)
+    if last is None:
+      return
+
+    test['resources'] = OrderedDict([
+      ("rssDelta", last["rss"] - first["rss"]),
+      ("rssPeak", max(sample["rss"] for sample in samples)),
+      ("cpu", round(last["cpu"] - first["cpu"], 3))
+    ])
+
+  def stop(self, results, fatal):
+    self.sampler.end()
@@ -7,8 +7,11 @@ import os
 import re
 import csv
 
+from collections import OrderedDict
 from base64 import b64encode, b64decode
-from nss import NSSSession
+from nss import createSession
+from utils import atomicFile
+from tracing import tracer
 
 class SignonFileEntry(object):
   def __init__(self, hostname="", httpRealm="", user="", password=""):
@@ -37,15 +40,24 @@ class SignonFileEntry(object):
 class Signons3File(object):
   def __init__(self, path="signons3.txt"):
     self.path = path
-    self.entries = set()
+    self.entries = OrderedDict()
     self.read()
+    self.dirty = False
 
   def add(self, entry):
-    self.entries.add(entry)
+    key = (entry.hostname, entry.httpRealm)
+    existing = self.entries.get(key)
+    if existing is None or str(existing) != str(entry):
+      self.entries[key] = entry
+      self.dirty = True
 
   def addEntry(self, hostname, httpRealm, user, password):
     self.add(SignonFileEntry(hostname, httpRealm, user, password))
 
+  def addEntries(self, entries):
+    for entry in entries:
+      self.add(entry)
+
   def read(self, fp=None):
     if fp is None:
       if os.path.exists(self.path):
@@ -107,30 +119,42 @@ class Signons3File(object):
 
   def write(self, fp=None):
     if fp is None:
-      fp = open(self.path, "w")
+      if not self.dirty:
+        return
+      with atomicFile(self.path) as fp:
+        self.write(fp)
+      self.dirty = False
+      return
 
     fp.write("\n".join(["#2e", "."]) + "\n")
-    fp.write("\n".join(map(str, self.entries)))
-    fp.close()
+    fp.write("\n".join(map(str, self.entries.values())))
 
 
 class SignonsSQLFile(object):
-  def __init__(self, profilePath, binPath, signonsSQLPath=None):
+  def __init__(self, profilePath, binPath, signonsSQLPath=None, nssCache=None,
+               nssSession=None):
     self.profilePath = profilePath
     self.binPath = binPath
 
     if not signonsSQLPath:
         signonsSQLPath  = os.path.join(profilePath, "signons.sqlite")
 
-    self.nssSession = NSSSession(self.binPath, self.profilePath)
+    self.nssSession = nssSession or createSession(self.binPath, self.profilePath,
+                                                  cacheDir=nssCache)
     self.conn = sqlite3.connect(signonsSQLPath)
 
+    # Durability is not needed while provisioning, a profile interrupted
+    # half way through is rebuilt anyway. These only affect this connection.
+    self.conn.execute("PRAGMA journal_mode = MEMORY")
+    self.conn.execute("PRAGMA synchronous = OFF")
+
     c = self.conn.cursor()
     c.execute("PRAGMA user_version")
     version = c.fetchone()
     c.close()
     if version is None or version[0] == 0:
       self.initSchema()
+    self.dirty = False
 
   def close(self):
     self.conn.close()
@@ -180,56 +204,112 @@ class SignonsSQLFile(object):
     c.close()
 
   def write(self):
-    self.nssSession.stop()
-    self.conn.commit()
+    with tracer.span("signons.write"):
+      self.nssSession.stop()
+      if self.dirty:
+        self.conn.commit()
+        self.dirty = False
 
   def addEntry(self, hostname, httpRealm, user, password):
+    self.addEntries([SignonFileEntry(hostname, httpRealm, user, password)])
+
+  def addEntries(self, entries):
+    with tracer.span("signons.addEntries", count=len(entries)):
+      self._addEntries(entries)
+
+  def _addEntries(self, entries):
     now = math.floor(time.time() * 1000)
-    params = dict()
-
-    # Explicit args
-    params['hostname'] = hostname
-    params['httpRealm'] = httpRealm
-    params['encryptedUsername'] = self.nssSession.encrypt(user)
-    params['encryptedPassword'] = self.nssSession.encrypt(password)
-
-    # automatic args
-    params['formSubmitURL'] = ''
-    params['usernameField'] = ''
-    params['passwordField'] = ''
-    params['guid'] = "{%s}" % str(uuid.uuid4())
-    params['encType'] = 1
-    params['timeCreated'] = now
-    params['timeLastUsed'] = now
-    params['timePasswordChanged'] = now
-    params['timesUsed'] = 1
 
-    c = self.conn.cursor()
-    if self.conn.execute("""SELECT 1 FROM moz_logins
-                             WHERE (hostname=:hostname AND httpRealm=:httpRealm)
-                             """, params).fetchone() is None:
-        c.execute("""INSERT INTO moz_logins
-                       (hostname, httpRealm, formSubmitURL, usernameField,
-                        passwordField, encryptedUsername, encryptedPassword, guid,
-                        encType, timeCreated, timeLastUsed, timePasswordChanged,
-                        timesUsed)
-                      VALUES (:hostname, :httpRealm, :formSubmitURL,
-                              :usernameField, :passwordField, :encryptedUsername,
-                              :encryptedPassword, :guid, :encType, :timeCreated,
-                              :timeLastUsed, :timePasswordChanged, :timesUsed)
-                   """, params)
-    else:
-        c.execute("""UPDATE moz_logins
-                        SET guid=:guid, encType=:encType,
-                            encryptedUsername=:encryptedUsername,
-                            encryptedPassword=:encryptedPassword,
-                            timeCreated=:timeCreated,
-                            timeLastUsed=:timeLastUsed,
-                            timePasswordChanged=:timePasswordChanged,
-                            timesUsed=:timesUsed
-                   """, params)
-    self.conn.commit()
-    c.close()
+    # Logins are unique by hostname and realm, the last entry wins
+    unique = OrderedDict()
+    for entry in entries:
+      unique[(entry.hostname, entry.httpRealm)] = entry
+    entries = self._changedEntries(unique)
+    if not len(entries):
+      return
+
+    # Encrypt all credentials in one round trip to the NSS helper
+    encrypted = self.nssSession.encrypt_many(
+      [value for entry in entries for value in (entry.user, entry.password)]
+    )
+
+    rows = []
+    for i, entry in enumerate(entries):
+      rows.append({
+        # Explicit args
+        'hostname': entry.hostname,
+        'httpRealm': entry.httpRealm,
+        'encryptedUsername': encrypted[2 * i],
+        'encryptedPassword': encrypted[2 * i + 1],
+
+        # automatic args
+        'formSubmitURL': '',
+        'usernameField': '',
+        'passwordField': '',
+        'guid': "{%s}" % str(uuid.uuid4()),
+        'encType': 1,
+        'timeCreated': now,
+        'timeLastUsed': now,
+        'timePasswordChanged': now,
+        'timesUsed': 1
+      })
+
+    # Update existing logins and insert the missing ones in one transaction.
+    # The schema is Thunderbird's and has no unique index on hostname and
+    # realm, so the upsert is expressed as UPDATE followed by INSERT ... WHERE
+    # NOT EXISTS. Existing logins keep their guid and creation time.
+    with self.conn:
+      self.conn.executemany("""UPDATE moz_logins
+                                  SET encType=:encType,
+                                      encryptedUsername=:encryptedUsername,
+                                      encryptedPassword=:encryptedPassword,
+                                      timeLastUsed=:timeLastUsed,
+                                      timePasswordChanged=:timePasswordChanged,
+                                      timesUsed=:timesUsed
+                                WHERE hostname=:hostname AND httpRealm IS :httpRealm
+                            """, rows)
+      self.conn.executemany("""INSERT INTO moz_logins
+                                 (hostname, httpRealm, formSubmitURL, usernameField,
+                                  passwordField, encryptedUsername, encryptedPassword, guid,
+                                  encType, timeCreated, timeLastUsed, timePasswordChanged,
+                                  timesUsed)
+                               SELECT :hostname, :httpRealm, :formSubmitURL,
+                                      :usernameField, :passwordField, :encryptedUsername,
+                                      :encryptedPassword, :guid, :encType, :timeCreated,
+                                      :timeLastUsed, :timePasswordChanged, :timesUsed
+                                WHERE NOT EXISTS (SELECT 1 FROM moz_logins
+                                                   WHERE hostname=:hostname AND
+                                                         httpRealm IS :httpRealm)
+                            """, rows)
+    self.dirty = True
+
+  def _changedEntries(self, unique):
+    # Compare with the stored logins so that reusing a profile does not
+    # rewrite credentials that are already correct.
+    existing = {}
+    for row in self.conn.execute("""SELECT hostname, httpRealm, encryptedUsername,
+                                           encryptedPassword FROM moz_logins"""):
+      if (row[0], row[1]) in unique:
+        existing[(row[0], row[1])] = (row[2], row[3])
+
+    if not len(existing):
+      return unique.values()
+
+    keys = existing.keys()
+    try:
+      decrypted = self.nssSession.decrypt_many(
+        [value for key in keys for value in existing[key]]
+      )
+    except Exception:
+      # Stored logins that can't be decrypted are replaced
+      return unique.values()
+
+    unchanged = set()
+    for i, key in enumerate(keys):
+      entry = unique[key]
+      if (entry.user, entry.password) == (decrypted[2 * i], decrypted[2 * i + 1]):
+        unchanged.add(key)
+    return [entry for key, entry in unique.items() if key not in unchanged]
 
 if __name__ == "__main__":
   sfile = Signons3File()
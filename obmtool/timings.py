@@ -0,0 +1,121 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import heapq
+import os
+import sqlite3
+
+# The mozinfo keys that make up the version a duration was measured with
+VERSION_KEYS = ("tb_version", "lightning_version", "obm_version")
+
+class TimingDatabase(object):
+  """ Per-test durations of earlier mozmill runs, by test path and the
+      Thunderbird, Lightning and OBM versions they ran with.
+  """
+
+  # Durations are averaged over at most this many runs, so that the
+  # estimate follows tests that get slower or faster over time.
+  MAX_RUNS = 10
+
+  def __init__(self, path):
+    dirname = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(dirname):
+      os.makedirs(dirname)
+
+    self.conn = sqlite3.connect(path)
+    self.conn.executescript("""
+      CREATE TABLE IF NOT EXISTS durations (
+        path                TEXT NOT NULL,
+        tb_version          TEXT NOT NULL,
+        ltn_version         TEXT NOT NULL,
+        obm_version         TEXT NOT NULL,
+        duration            REAL NOT NULL,
+        runs                INTEGER NOT NULL,
+        PRIMARY KEY (path, tb_version, ltn_version, obm_version)
+      );
+      """)
+
+  def close(self):
+    self.conn.close()
+
+  @staticmethod
+  def versions(info):
+    return tuple(str(info.get(key, "")) for key in VERSION_KEYS)
+
+  def estimate(self, path, versions):
+    row = self.conn.execute("""SELECT duration FROM durations
+                                WHERE path=? AND tb_version=? AND
+                                      ltn_version=? AND obm_version=?
+                            """, (path,) + versions).fetchone()
+    if row is None:
+      # Fall back to the durations measured with other versions
+      row = self.conn.execute("""SELECT AVG(duration) FROM durations
+                                  WHERE path=?""", (path,)).fetchone()
+    return row[0] if row else None
+
+  def record(self, durations, versions):
+    with self.conn:
+      for path, duration in durations.iteritems():
+        row = self.conn.execute("""SELECT duration, runs FROM durations
+                                    WHERE path=? AND tb_version=? AND
+                                          ltn_version=? AND obm_version=?
+                                """, (path,) + versions).fetchone()
+        if row:
+          runs = min(row[1], TimingDatabase.MAX_RUNS - 1)
+          duration = (row[0] * runs + duration) / (runs + 1)
+          runs += 1
+        else:
+          runs = 1
+        self.conn.execute("""INSERT OR REPLACE INTO durations
+                               (path, tb_version, ltn_version, obm_version,
+                                duration, runs)
+                              VALUES (?, ?, ?, ?, ?, ?)
+                          """, (path,) + versions + (duration, runs))
+
+def testDurations(results):
+  """ Sums up the duration in seconds of each test file from the mozmill
+      results, keyed by the real path of the file.
+  """
+  durations = {}
+  for test in results.alltests:
+    if 'time_start' not in test or 'time_end' not in test or not test.get('filename'):
+      continue
+    path = os.path.realpath(test['filename'])
+    seconds = (test['time_end'] - test['time_start']) / 1000.0
+    durations[path] = durations.get(path, 0) + seconds
+  return durations
+
+def schedule(tests, jobs, estimates):
+  """ Distributes tests over jobs shards using longest processing time
+      first. Tests without an estimate are assumed to take as long as the
+      average test. Returns the shards, each sorted longest first, and the
+      predicted duration of each shard.
+  """
+  known = [x for x in estimates.values() if x is not None]
+  default = sum(known) / len(known) if len(known) else 1.0
+
+  def duration(test):
+    value = estimates.get(test['path'])
+    return default if value is None else value
+
+  shards = [[] for i in range(jobs)]
+  loads = [(0.0, i) for i in range(jobs)]
+  for test in sorted(tests, key=duration, reverse=True):
+    load, index = heapq.heappop(loads)
+    shards[index].append(test)
+    heapq.heappush(loads, (load + duration(test), index))
+
+  predicted = [0.0] * jobs
+  for load, index in loads:
+    predicted[index] = load
+  return shards, predicted
+
+def makespanReport(predicted, actual):
+  if not predicted or not actual:
+    return "No tests were run"
+  lines = ["Predicted makespan %.1fs, actual %.1fs" % (max(predicted), max(actual))]
+  if len(predicted) > 1:
+    for index, (p, a) in enumerate(zip(predicted, actual)):
+      lines.append("  shard %d: predicted %.1fs, actual %.1fs" % (index, p, a))
+  return "\n".join(lines)
@@ -0,0 +1,87 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+from utils import atomicFile
+
+class Tracer(object):
+  """ Records nested spans of the startup phases.
+
+      Spans are only recorded after enable() has been called, until then
+      span() does nothing. The spans can be written in the Chrome trace
+      event format, which chrome://tracing and Perfetto can open.
+  """
+
+  def __init__(self):
+    self.enabled = False
+    self.origin = time.time()
+    self.events = []
+    self.local = threading.local()
+
+  def enable(self):
+    self.enabled = True
+
+  @contextmanager
+  def span(self, name, **args):
+    if not self.enabled:
+      yield
+      return
+
+    stack = self.local.__dict__.setdefault("stack", [])
+    stack.append(name)
+    start = time.time()
+    try:
+      yield
+    finally:
+      end = time.time()
+      stack.pop()
+      event = {
+        "name": name,
+        "cat": name.split(".")[0],
+        "ph": "X",
+        "ts": int((start - self.origin) * 1000000),
+        "dur": int((end - start) * 1000000),
+        "pid": os.getpid(),
+        "tid": threading.current_thread().ident,
+        "depth": len(stack)
+      }
+      if args:
+        event["args"] = dict((k, str(v)) for k, v in args.iteritems())
+      self.events.append(event)
+
+  def save(self, path):
+    events = []
+    for event in self.events:
+      event = dict(event)
+      del event["depth"]
+      events.append(event)
+
+    with atomicFile(path) as fp:
+      json.dump({ "traceEvents": events, "displayTimeUnit": "ms" }, fp)
+
+  def summary(self):
+    """ Returns a table of the time spent in each phase, in the order the
+        phases were first entered.
+    """
+    phases = OrderedDict()
+    for event in sorted(self.events, key=lambda x: x["ts"]):
+      phase = phases.setdefault(event["name"], [event["depth"], 0, 0])
+      phase[1] += 1
+      phase[2] += event["dur"]
+
+    lines = ["%-40s %6s %10s" % ("Phase", "Count", "Time (ms)")]
+    for name, (depth, count, duration) in phases.iteritems():
+      lines.append("%-40s %6d %10.1f" % ("  " * depth + name, count, duration / 1000.0))
+    lines.append("%-40s %6s %10.1f" % ("Total since start", "",
+                                       (time.time() - self.origin) * 1000))
+    return "\n".join(lines)
+
+# our global instance
+tracer = Tracer()
@@ -3,14 +3,18 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 # Portions Copyright (C) Philipp Kewisch, 2014
 
+import json
+import logging
 import os
 import os.path
+import tempfile
 import zipfile
 import iniparse
-import xml.dom.minidom
+import xml.parsers.expat
 
 import mozinfo
-import mozversion
+
+from contextlib import contextmanager
 
 if mozinfo.isMac:
     from plistlib import readPlist
@@ -25,23 +29,151 @@ def setupMozinfo(args):
   info.update(setupExtensionInfo(args.obm, "obm"))
   info.update(setupExtensionInfo(args.lightning, "lightning"))
 
-  tbversion = mozversion.get_version(args.thunderbird)['application_version']
+  tbversion = applicationVersion(args.thunderbird)
   info.update(createVersionProps(tbversion, "tb"))
 
   return info
 
 def setupExtensionInfo(path, prefix):
-  root, ext = os.path.splitext(path)
+  return createVersionProps(readInstallManifest(path)["version"], prefix)
+
+class MetadataIndex(object):
+  """ Persistent index of values read from files, like add-on versions.
+
+      Entries are keyed by the path they describe and are only used while
+      the size and mtime of the file they were read from are unchanged. The
+      index is disabled until open() is called with a path.
+  """
+
+  def __init__(self):
+    self.path = None
+    self.entries = {}
+    self.dirty = False
+
+  def open(self, path):
+    if path == self.path:
+      # Already open, e.g. in obmtool serve. The entries are up to date.
+      return
+
+    self.path = path
+    self.entries = {}
+    self.dirty = False
+    if os.path.exists(path):
+      try:
+        with open(path) as fp:
+          self.entries = json.load(fp)
+      except ValueError:
+        logging.warning("Ignoring corrupt metadata index %s" % path)
+
+  def lookup(self, kind, path, statPath, reader):
+    st = os.stat(statPath)
+    key = "%s:%s" % (kind, os.path.abspath(path))
+    stamp = [st.st_size, st.st_mtime]
+
+    entry = self.entries.get(key)
+    if entry and entry["stamp"] == stamp:
+      return entry["data"]
+
+    data = reader()
+    self.entries[key] = { "stamp": stamp, "data": data }
+    self.dirty = True
+    return data
+
+  def save(self):
+    if not self.path or not self.dirty:
+      return
+
+    dirname = os.path.dirname(os.path.abspath(self.path))
+    if not os.path.isdir(dirname):
+      os.makedirs(dirname)
+    with atomicFile(self.path) as fp:
+      json.dump(self.entries, fp)
+    self.dirty = False
+
+def applicationIni(binary):
+  """ The application.ini next to the binary, in Resources on newer mac
+      builds, or the binary itself if there is none.
+  """
+  dirname = os.path.dirname(os.path.abspath(binary))
+  for path in (os.path.join(dirname, "application.ini"),
+               os.path.join(dirname, "..", "Resources", "application.ini")):
+    if os.path.exists(path):
+      return path
+  return binary
+
+def applicationVersion(binary):
+  import mozversion
+  # An update replaces application.ini, the binary may stay the same
+  return metadata.lookup("application", binary, applicationIni(binary), lambda:
+                         mozversion.get_version(binary)['application_version'])
+
+def readInstallManifest(path):
+  """ Returns the add-on's own id and version from the install.rdf of an
+      unpacked extension directory or an xpi.
+  """
+  def read():
+    if os.path.isdir(path):
+      with open(os.path.join(path, "install.rdf")) as installRDF:
+        return parseInstallManifest(installRDF)
+    else:
+      with zipfile.ZipFile(path) as zippi:
+        return parseInstallManifest(zippi.open("install.rdf"))
+
+  statPath = path
   if os.path.isdir(path):
-    with open(os.path.join(path, "install.rdf")) as installRDF:
-      dom = xml.dom.minidom.parse(installRDF)
-  elif ext.lower() == ".xpi":
-    with zipfile.ZipFile(path) as zippi:
-      installRDF = zippi.open("install.rdf")
-      dom = xml.dom.minidom.parse(installRDF)
+    statPath = os.path.join(path, "install.rdf")
+  return metadata.lookup("addon", path, statPath, read)
+
+def parseInstallManifest(fp):
+  """ Streams install.rdf until the add-on's own em:id and em:version have
+      been seen. The ids and versions of targetApplication entries are
+      skipped. Both element and attribute notation are supported.
+  """
+  EM_NS = "http://www.mozilla.org/2004/em-rdf#"
+  KEYS = ("id", "version")
+
+  class Done(Exception):
+    pass
 
-  version = dom.getElementsByTagNameNS("*", "version")[0].firstChild.nodeValue
-  return createVersionProps(version, prefix)
+  manifest = {}
+  state = { "target": 0, "key": None, "text": [] }
+
+  def start(name, attrs):
+    ns, _, localName = name.rpartition(" ")
+    if localName == "targetApplication":
+      state["target"] += 1
+    elif state["target"]:
+      return
+    for key in KEYS:
+      if key not in manifest and (EM_NS + " " + key) in attrs:
+        manifest[key] = attrs[EM_NS + " " + key]
+    if ns == EM_NS and localName in KEYS and localName not in manifest:
+      state["key"] = localName
+      state["text"] = []
+
+  def end(name):
+    ns, _, localName = name.rpartition(" ")
+    if localName == "targetApplication":
+      state["target"] -= 1
+    elif state["key"]:
+      manifest[state["key"]] = "".join(state["text"]).strip()
+      state["key"] = None
+    if len(manifest) == len(KEYS):
+      raise Done()
+
+  def data(text):
+    if state["key"]:
+      state["text"].append(text)
+
+  parser = xml.parsers.expat.ParserCreate(namespace_separator=" ")
+  parser.StartElementHandler = start
+  parser.EndElementHandler = end
+  parser.CharacterDataHandler = data
+  try:
+    parser.ParseFile(fp)
+  except Done:
+    pass
+  return manifest
 
 def createVersionProps(version, prefix):
   def tryConvert(x):
@@ -70,3 +202,24 @@ def fixBinaryPath(binary):
     binary = os.path.join(binary, 'Contents/MacOS/',
                           readPlist(plist)['CFBundleExecutable'])
   return binary
+
+@contextmanager
+def atomicFile(path, mode="w"):
+  """ Yields a temporary file that replaces path once it has been written
+      completely. Readers see either the old or the new content.
+  """
+  dirname, basename = os.path.split(os.path.abspath(path))
+  fd, tmppath = tempfile.mkstemp(prefix=".%s-" % basename, dir=dirname)
+  try:
+    with os.fdopen(fd, mode) as fp:
+      yield fp
+    if os.name == "nt" and os.path.exists(path):
+      os.remove(path)
+    os.rename(tmppath, path)
+  except:
+    if os.path.exists(tmppath):
+      os.remove(tmppath)
+    raise
+
+# our global instance
+metadata = MetadataIndex()
@@ -38,5 +38,6 @@ setup(
     ],
 
     package_data={ 'sample': ['obmtoolrc'] },
-    entry_points={ 'console_scripts': [ 'obmtool=obmtool.app:main' ] },
+    entry_points={ 'console_scripts': [ 'obmtool=obmtool.app:main',
+                                      'obmtool-benchmark=obmtool.benchmark:main' ] },
 )